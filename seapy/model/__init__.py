@@ -11,6 +11,9 @@
 
   Imported functions include:
 
+  - :func:`~seapy.model.grid.asgrid`
+  - :func:`~seapy.model.grid.clear_grid_cache`
+  - :func:`~seapy.model.grid.set_grid_cache`
   - :func:`~seapy.model.lib.bvf`
   - :func:`~seapy.model.lib.density`
   - :func:`~seapy.model.hycom.load_history`
@@ -24,7 +27,7 @@
   - :func:`~seapy.model.lib.v2rho`
   - :func:`~seapy.model.lib.w`
 """
-from .grid import grid, asgrid
+from .grid import grid, asgrid, set_grid_cache, clear_grid_cache
 from .lib import *
 from .hycom import *
 from .soda import *
@@ -17,15 +17,115 @@
 
 import os
 import re
+import json
+import hashlib
 import seapy
 import numpy as np
 import scipy.spatial
 import matplotlib.path
 import netCDF4
+from collections import OrderedDict
 from warnings import warn
 
 
-def asgrid(grid):
+# Cache of the grids built by asgrid, keyed on the identity of the file(s).
+# It holds up to _grid_cache_size grids and is off (size 0) by default.
+_grid_cache = OrderedDict()
+_grid_cache_size = 0
+
+
+def set_grid_cache(size=8):
+    """
+    Enable (or disable) the process-wide cache of grids built by asgrid.
+    When enabled, repeated calls to asgrid with the same, unchanged file
+    return the same grid object rather than building a new one. The least
+    recently used grids are dropped once the cache holds more than size.
+
+    NOTE: the cached grids are shared, so changes made to one (for
+    example, by set_east) are seen by every user of that grid.
+
+    Parameters
+    ----------
+    size: int, optional
+        Maximum number of grids to keep. A size of 0 disables the cache.
+
+    Returns
+    -------
+    None
+
+    Examples
+    --------
+    >>> seapy.model.set_grid_cache(4)
+    >>> g = seapy.model.asgrid("grid_file.nc")
+    >>> g is seapy.model.asgrid("grid_file.nc")
+    True
+    """
+    global _grid_cache_size
+    _grid_cache_size = max(0, int(size))
+    while len(_grid_cache) > _grid_cache_size:
+        _grid_cache.popitem(last=False)
+
+
+def clear_grid_cache():
+    """
+    Remove all grids from the asgrid cache.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    _grid_cache.clear()
+
+
+def _grid_cache_key(filename, options):
+    """
+    PRIVATE method: build the cache key of (absolute path, mtime, size) for
+    each file and the options used. Returns None if the files cannot be
+    identified (e.g., a wildcard string).
+    """
+    try:
+        files = [filename] if isinstance(filename, str) else \
+            list(seapy.flatten(filename))
+        ident = []
+        for f in files:
+            st = os.stat(f)
+            ident.append((os.path.abspath(f), st.st_mtime_ns, st.st_size))
+        return (tuple(ident), tuple(sorted(options.items())))
+    except (OSError, TypeError):
+        return None
+
+
+def _file_identity(filename, known=None):
+    """
+    PRIVATE method: return the path, size, modification time, and sha256
+    hash of the grid file(s) or None if they cannot be found. If the known
+    identity is given and the size and time match, the hash is not
+    recomputed.
+    """
+    try:
+        files = [filename] if isinstance(filename, str) else \
+            list(seapy.flatten(filename))
+        ident = {"files": [os.path.abspath(f) for f in files],
+                 "size": [os.stat(f).st_size for f in files],
+                 "mtime": [os.stat(f).st_mtime_ns for f in files]}
+    except (OSError, TypeError):
+        return None
+    if known is not None and all(known.get(k) == ident[k] for k in ident):
+        return known
+    sha = hashlib.sha256()
+    for f in files:
+        with open(f, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                sha.update(block)
+    ident["sha256"] = sha.hexdigest()
+    return ident
+
+
+def asgrid(grid, cache=None, **kwargs):
     """
     Return either an existing or new grid object. This decorator will ensure that
     the variable being used is a seapy.model.grid. If it is not, it will attempt
@@ -36,6 +136,12 @@ def asgrid(grid):
     grid: string, list, netCDF4 Dataset, or model.seapy.grid
         Input variable to cast. If it is already a grid, it will return it;
         otherwise, it attempts to construct a new grid.
+    cache: bool, optional
+        If True, return the grid from the cache if the same file was loaded
+        before (and store new grids in it). The default, None, uses the
+        cache only if it is enabled by set_grid_cache.
+    **kwargs: optional
+        Options (depths, cgrid) passed to construct the new grid
 
     Returns
     -------
@@ -47,13 +153,210 @@ def asgrid(grid):
     if isinstance(grid, seapy.model.grid):
         return grid
     if isinstance(grid, netCDF4._netCDF4.Dataset):
-        return seapy.model.grid(nc=grid)
-    else:
-        return seapy.model.grid(filename=grid)
+        return seapy.model.grid(nc=grid, **kwargs)
+
+    # Check the cache for the file
+    if cache is None:
+        cache = _grid_cache_size > 0
+    key = _grid_cache_key(grid, kwargs) if cache else None
+    if key is not None and key in _grid_cache:
+        _grid_cache.move_to_end(key)
+        return _grid_cache[key]
+
+    new_grid = seapy.model.grid(filename=grid, **kwargs)
+    if key is not None:
+        _grid_cache[key] = new_grid
+        while len(_grid_cache) > max(1, _grid_cache_size):
+            _grid_cache.popitem(last=False)
+    return new_grid
+
+
+class _spatial_index:
+    """
+    PRIVATE class: spatial index of the points of a grid staggering used to
+    find the nearest points and the fractional cell indices for a set of
+    longitude/latitude positions. The tree is built once and reused; it is
+    safe to pickle.
+    """
+    # Constants as defined in the ROMS hindices routine
+    _eradius = 6371315.0
+    _deg2rad = float(np.float32(np.pi)) / 180.0
+    # Number of nearest grid points to consider the neighboring cells of
+    _neighbors = 4
+
+    def __init__(self, lon, lat):
+        self.lon = np.ma.getdata(lon).astype(float)
+        self.lat = np.ma.getdata(lat).astype(float)
+        self.shape = self.lat.shape
+        self.tree = scipy.spatial.cKDTree(
+            np.dstack([self.lat.ravel(), self.lon.ravel()])[0])
+        self.boundary = matplotlib.path.Path(np.vstack((
+            np.concatenate([self.lon[0, :], self.lon[:, -1],
+                            self.lon[-1, ::-1], self.lon[::-1, 0]]),
+            np.concatenate([self.lat[0, :], self.lat[:, -1],
+                            self.lat[-1, ::-1], self.lat[::-1, 0]]))).T)
+
+    def nearest(self, lon, lat):
+        """
+        Return the indices of the grid points nearest each position
+        """
+        pts = np.dstack([np.atleast_1d(lat), np.atleast_1d(lon)])[0]
+        dist, idx = self.tree.query(pts)
+        return np.unravel_index(idx, self.shape)
+
+    @staticmethod
+    def _inside(xb, yb, xo, yo):
+        """
+        Vectorized version of the ROMS 'inside' crossing test of the
+        quadrilaterals (xb, yb) [npts, 4] for the points (xo, yo). Points
+        on the boundary are inside.
+        """
+        crossings = np.zeros(xo.shape, dtype=int)
+        vertex = np.zeros(xo.shape, dtype=bool)
+        for k in range(4):
+            x1, x2 = xb[:, k], xb[:, (k + 1) % 4]
+            y1, y2 = yb[:, k], yb[:, (k + 1) % 4]
+            sel = np.logical_and((x2 - xo) * (xo - x1) >= 0, x1 != x2)
+            dx1 = xo - x1
+            dx2 = x2 - xo
+            dxy = dx2 * (yo - y1) - dx1 * (y2 - yo)
+            vertex |= sel & (x1 == xo) & (y1 == yo)
+            inc = np.where(((dx1 == 0) & (yo >= y1)) |
+                           ((dx2 == 0) & (yo >= y2)), 1,
+                           np.where((dx1 * dx2 > 0) &
+                                    ((x2 - x1) * dxy >= 0), 2, 0))
+            crossings += sel * np.where(x2 > x1, inc, -inc)
+        return np.logical_or(crossings != 0, vertex)
+
+    def _cells(self, lon, lat, k):
+        """
+        Return the (j, i) indices of the cell containing each point from
+        the cells that have one of the k nearest points as a corner, or -1
+        if not found.
+        """
+        _, idx = self.tree.query(np.dstack([lat, lon])[0],
+                                 k=min(k, self.tree.n))
+        jn, jin = np.unravel_index(idx.reshape(lon.size, -1), self.shape)
+        ln, lm = self.shape
+        # The candidates are ordered by i, then j, so that a point on the edge
+        # of two cells is given to the same cell as the ROMS binary search.
+        off = np.array([-1, 0, -1, 0]), np.array([-1, -1, 0, 0])
+        cand_j = np.clip(jn[:, :, np.newaxis] + off[0], 0, ln - 2).reshape(
+            lon.size, -1)
+        cand_i = np.clip(jin[:, :, np.newaxis] + off[1], 0, lm - 2).reshape(
+            lon.size, -1)
+
+        # Test each candidate until the cell is found
+        cj = np.full(lon.size, -1)
+        ci = np.full(lon.size, -1)
+        for n in range(cand_j.shape[1]):
+            todo = np.nonzero(cj < 0)[0]
+            if not todo.size:
+                break
+            j, i = cand_j[todo, n], cand_i[todo, n]
+            xb = np.stack((self.lon[j, i], self.lon[j, i + 1],
+                           self.lon[j + 1, i + 1], self.lon[j + 1, i]), axis=1)
+            yb = np.stack((self.lat[j, i], self.lat[j, i + 1],
+                           self.lat[j + 1, i + 1], self.lat[j + 1, i]), axis=1)
+            found = todo[self._inside(xb, yb, lon[todo], lat[todo])]
+            cj[found] = cand_j[found, n]
+            ci[found] = cand_i[found, n]
+        return cj, ci
+
+    def ij(self, lon, lat, angle):
+        """
+        Return the fractional (j, i) indices of each position, with -999
+        for positions outside of the grid
+        """
+        lon = np.atleast_1d(lon).astype(float)
+        lat = np.atleast_1d(lat).astype(float)
+        jpos = np.full(lon.shape, -999.0)
+        ipos = np.full(lon.shape, -999.0)
+        if not lon.size:
+            return jpos, ipos
+
+        # Find the cell containing each point from the cells around the
+        # nearest grid point. For those not found that lie within the grid,
+        # try the cells around the next nearest points.
+        cj = np.full(lon.size, -1)
+        ci = np.full(lon.size, -1)
+        todo = np.arange(lon.size)
+        for k in (1, self._neighbors):
+            if k > 1:
+                todo = todo[cj[todo] < 0]
+                if todo.size:
+                    todo = todo[self.boundary.contains_points(
+                        np.vstack((lon[todo], lat[todo])).T)]
+            if not todo.size:
+                break
+            cj[todo], ci[todo] = self._cells(lon[todo], lat[todo], k)
+
+        # Solve for the fractional index within each cell
+        good = np.nonzero(cj >= 0)[0]
+        j = cj[good]
+        i = ci[good]
+        xo, yo = lon[good], lat[good]
+        yfac = self._eradius * self._deg2rad
+        xfac = yfac * np.cos(yo * self._deg2rad)
+        xpp = (xo - self.lon[j, i]) * xfac
+        ypp = (yo - self.lat[j, i]) * yfac
+        diag2 = ((self.lon[j, i + 1] - self.lon[j + 1, i]) * xfac)**2 + \
+            ((self.lat[j, i + 1] - self.lat[j + 1, i]) * yfac)**2
+        aa2 = ((self.lon[j, i] - self.lon[j, i + 1]) * xfac)**2 + \
+            ((self.lat[j, i] - self.lat[j, i + 1]) * yfac)**2
+        bb2 = ((self.lon[j, i] - self.lon[j + 1, i]) * xfac)**2 + \
+            ((self.lat[j, i] - self.lat[j + 1, i]) * yfac)**2
+        phi = np.arcsin((diag2 - aa2 - bb2) / (2.0 * np.sqrt(aa2 * bb2)))
+        ang = angle[j, i]
+        dx = xpp * np.cos(ang) + ypp * np.sin(ang)
+        dy = ypp * np.cos(ang) - xpp * np.sin(ang)
+        dx = dx + dy * np.tan(phi)
+        dy = dy / np.cos(phi)
+        ipos[good] = i + np.minimum(np.maximum(0.0, dx / np.sqrt(aa2)), 1.0)
+        jpos[good] = j + np.minimum(np.maximum(0.0, dy / np.sqrt(bb2)), 1.0)
+
+        # Anything within the grid that was not found among the neighbors
+        # is searched for directly
+        missed = todo[cj[todo] < 0]
+        if missed.size:
+            from seapy.external.hindices import hindices
+            ipos[missed], jpos[missed] = hindices(
+                angle.T, self.lon.T, self.lat.T, lon[missed], lat[missed])
+        return jpos, ipos
 
 
 class grid:
 
+    # Attributes that are not loaded or computed until they are first
+    # accessed. Each maps to the method that will set it in the grid.
+    _derived = {"lat_u": "_set_uv_coords",
+                "lon_u": "_set_uv_coords",
+                "lat_v": "_set_uv_coords",
+                "lon_v": "_set_uv_coords",
+                "mask_u": "_set_uv_masks",
+                "mask_v": "_set_uv_masks",
+                "dm": "_set_metrics",
+                "dn": "_set_metrics",
+                "pm": "_set_metrics",
+                "pn": "_set_metrics",
+                "f": "_set_coriolis",
+                "I": "_set_indices",
+                "J": "_set_indices",
+                "s_rho": "_set_stretching",
+                "cs_r": "_set_stretching",
+                "depth_rho": "_set_depth_rho",
+                "depth_u": "_set_depth_uv",
+                "depth_v": "_set_depth_uv",
+                "thick_rho": "_set_thick_rho",
+                "thick_u": "_set_thick_uv",
+                "thick_v": "_set_thick_uv",
+                "mask_rho": "set_mask_h",
+                "h": "set_mask_h"}
+
+    # The derived attributes that require the depths option
+    _depth_methods = ("_set_stretching", "_set_depth_rho", "_set_depth_uv",
+                      "_set_thick_rho", "_set_thick_uv", "set_mask_h")
+
     def __init__(self, filename=None, nc=None, lat=None, lon=None, z=None,
                  depths=True, cgrid=False):
         """
@@ -62,6 +365,11 @@ class grid:
             parameters. A grid can be constructed by specifying a filename or
             by specifying lat, lon, and z.
 
+            Only the dimensions of the grid are read when it is constructed.
+            All other fields (from the file or derived, such as depth_rho or
+            thick_u) are loaded or computed the first time they are accessed
+            and are kept thereafter.
+
             Parameters
             ----------
             filename: filename or list, optional
@@ -86,13 +394,16 @@ class grid:
         self.filename = filename
         self.cgrid = cgrid
         self._nc = nc
+        self._depths = depths
+        self._lazy_done = set()
+        self.key = {}
 
         if (self.filename or self._nc) is not None:
             self._initfile()
             self._isroms = True if \
                 (len(list(set(("s_rho", "pm", "pn", "theta_s", "theta_b",
                                "vtransform", "vstretching")).intersection(
-                    set(self.__dict__)))) > 0) else False
+                    set(self.key)))) > 0) else False
             self.cgrid = True if self._isroms else self.cgrid
         else:
             self._nc = None
@@ -102,18 +413,70 @@ class grid:
             self.z = z
             self.cgrid = False
         self._verify_shape()
-        if depths:
-            self.set_dims()
-            self.set_depth()
-            self.set_thickness()
-            self.set_mask_h()
+        self._set_layers()
         self.ijinterp = None
         self.llinterp = None
 
+    def __getattr__(self, name):
+        """
+        Load the field from the file or compute the derived field the first
+        time that it is requested.
+        """
+        # Only called when the attribute is not already set. Guard against
+        # private lookups (e.g., during unpickling) before we are built.
+        if name.startswith("_") or "key" not in self.__dict__:
+            raise AttributeError(name)
+        if name in self.key:
+            self.__dict__[name] = self._load(name)
+            return self.__dict__[name]
+        method = self._derived.get(name)
+        if method is not None and method not in self._lazy_done and \
+                (self._depths or method not in self._depth_methods):
+            self._lazy_done.add(method)
+            getattr(self, method)()
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError(
+            "'grid' object has no attribute '{:s}'".format(name))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_nc"] = None
+        return state
+
+    def _has(self, name):
+        """
+        PRIVATE method: True if the attribute is set or available from the
+        file without computing it.
+        """
+        return name in self.__dict__ or name in self.key
+
+    def _load(self, name):
+        """
+        PRIVATE method: read the given field from the grid file
+        """
+        nc = self._nc
+        close = False
+        try:
+            if not nc.isopen():
+                raise AttributeError
+        except AttributeError:
+            if self._source is None:
+                raise AttributeError(
+                    "grid file is closed; cannot load {:s}".format(name))
+            nc = seapy.netcdf(self._source)
+            close = True
+        try:
+            return nc.variables[self._ncvars[name]][:]
+        finally:
+            if close:
+                nc.close()
+
     def _initfile(self):
         """
-        Using an input file, try to load as much information
-        as can be found in the given file.
+        Using an input file, find all of the information that can be
+        found in the given file. The values are not read until they
+        are used.
 
         Parameters
         ----------
@@ -167,13 +530,21 @@ class grid:
                                   os.path.basename(self.filename)).group()
         except:
             self.name = "untitled"
-        self.key = {}
+        self._source = self.filename
+        if self._source is None:
+            try:
+                self._source = self._nc.filepath()
+            except (AttributeError, ValueError):
+                pass
+        self._ncvars = {}
+        self._ncshape = {}
         ncvars = {v.lower(): v for v in self._nc.variables.keys()}
         for var in gvars:
             for inp in gvars[var]:
                 if inp in ncvars:
                     self.key[var] = inp
-                    self.__dict__[var] = self._nc.variables[ncvars[inp]][:]
+                    self._ncvars[var] = ncvars[inp]
+                    self._ncshape[var] = self._nc.variables[ncvars[inp]].shape
                     break
 
         if close:
@@ -195,19 +566,22 @@ class grid:
         None : sets attributes in grid
         """
         # Check that we have the minimum required data
-        if ("lat_rho" or "lon_rho") not in self.__dict__:
+        if not self._has("lat_rho") or not self._has("lon_rho"):
             raise AttributeError(
                 "grid does not have attribute lat_rho or lon_rho")
 
         # Check that it is formatted into 2-D
-        self.spatial_dims = self.lat_rho.ndim
-        if self.lat_rho.ndim == 1 and self.lon_rho.ndim == 1:
+        shape = np.shape(self.__dict__["lat_rho"]) \
+            if "lat_rho" in self.__dict__ else self._ncshape["lat_rho"]
+        self.spatial_dims = len(shape)
+        if self.spatial_dims == 1 and np.ndim(self.lon_rho) == 1:
             [self.lon_rho, self.lat_rho] = np.meshgrid(self.lon_rho,
                                                        self.lat_rho)
+            shape = self.lat_rho.shape
 
         # Compute the dimensions
-        self.ln = int(self.lat_rho.shape[0])
-        self.lm = int(self.lat_rho.shape[1])
+        self.ln = int(shape[0])
+        self.lm = int(shape[1])
         self.shape = (self.ln, self.lm)
         if self.cgrid:
             self.shape_u = (self.ln, self.lm - 1)
@@ -226,7 +600,7 @@ class grid:
                               "C-Grid" if self.cgrid else "A-Grid",
                               "S-level" if self._isroms else "Z-Level"),
                           "Available: " + ",".join(sorted(
-                              list(self.__dict__.keys())))))
+                              set(self.__dict__.keys()).union(self.key)))))
 
     def east(self):
         """
@@ -263,6 +637,7 @@ class grid:
         -------
         None : sets attributes in grid
         """
+        self.ijinterp = self.llinterp = None
         try:
             if east:
                 self.lon_rho[self.lon_rho < 0] += 360.0
@@ -277,7 +652,9 @@ class grid:
 
     def set_dims(self):
         """
-        Compute the dimension attributes of the grid based upon the information provided.
+        Compute the dimension attributes of the grid based upon the information
+        provided. These are computed on first use, so calling this is only
+        required to compute them all at once.
 
         Parameters
         ----------
@@ -287,6 +664,17 @@ class grid:
         -------
         None : sets attributes in grid
         """
+        self._set_layers()
+        self._set_uv_coords()
+        self._set_uv_masks()
+        self._set_metrics()
+        self._set_coriolis()
+        self._set_indices()
+
+    def _set_layers(self):
+        """
+        PRIVATE method: set the staggered dimensions and number of layers
+        """
         # If C-Grid, set the dimensions for consistency
         if self.cgrid:
             self.eta_rho = self.ln
@@ -297,19 +685,22 @@ class grid:
             self.xi_v = self.lm
 
         # Set the number of layers
-        if "n" not in self.__dict__:
-            if "s_rho" in self.__dict__:
-                self.n = int(self.s_rho.size)
-            elif "z" in self.__dict__:
-                self.n = int(self.z.size)
+        if not self._has("n"):
+            if self._has("s_rho"):
+                self.n = int(np.size(self.s_rho))
+            elif self._has("z"):
+                self.n = int(np.size(self.z))
             else:
                 self.n = 1
-                self.z = np.zeros(self.lat_rho.shape)
+                self.z = np.zeros(self.shape)
         else:
             self.n = int(self.n)
 
-        # Generate the u- and v-grids
-        if ("lat_u" or "lon_u") not in self.__dict__:
+    def _set_uv_coords(self):
+        """
+        PRIVATE method: generate the u- and v-grids
+        """
+        if not self._has("lat_u") or not self._has("lon_u"):
             if self.cgrid:
                 self.lat_u = 0.5 * \
                     (self.lat_rho[:, 1:] - self.lat_rho[:, 0:-1])
@@ -318,7 +709,7 @@ class grid:
             else:
                 self.lat_u = self.lat_rho
                 self.lon_u = self.lon_rho
-        if ("lat_v" or "lon_v") not in self.__dict__:
+        if not self._has("lat_v") or not self._has("lon_v"):
             if self.cgrid:
                 self.lat_v = 0.5 * \
                     (self.lat_rho[1:, :] - self.lat_rho[0:-1, :])
@@ -327,20 +718,28 @@ class grid:
             else:
                 self.lat_v = self.lat_rho
                 self.lon_v = self.lon_rho
-        if "mask_rho" in self.__dict__:
-            if "mask_u" not in self.__dict__:
+
+    def _set_uv_masks(self):
+        """
+        PRIVATE method: generate the u- and v-masks
+        """
+        if hasattr(self, "mask_rho"):
+            if not self._has("mask_u"):
                 if self.cgrid:
                     self.mask_u = self.mask_rho[:, 1:] * self.mask_rho[:, 0:-1]
                 else:
                     self.mask_u = self.mask_rho
-            if "mask_v" not in self.__dict__:
+            if not self._has("mask_v"):
                 if self.cgrid:
                     self.mask_v = self.mask_rho[1:, :] * self.mask_rho[0:-1, :]
                 else:
                     self.mask_v = self.mask_rho
 
-        # Compute the resolution
-        if "pm" in self.__dict__:
+    def _set_metrics(self):
+        """
+        PRIVATE method: compute the resolution of the grid
+        """
+        if self._has("pm"):
             self.dm = 1.0 / self.pm
         else:
             self.dm = np.ones(self.lon_rho.shape, dtype=np.float32)
@@ -350,7 +749,7 @@ class grid:
                                                     self.lat_rho[:, 0:-1]).astype(np.float32)
             self.dm[:, -1] = self.dm[:, -2]
             self.pm = 1.0 / self.dm
-        if "pn" in self.__dict__:
+        if self._has("pn"):
             self.dn = 1.0 / self.pn
         else:
             self.dn = np.ones(self.lat_rho.shape, dtype=np.float32)
@@ -361,12 +760,18 @@ class grid:
             self.dn[-1, :] = self.dn[-2, :]
             self.pn = 1.0 / self.dn
 
-        # Compute the Coriolis
-        if "f" not in self.__dict__:
+    def _set_coriolis(self):
+        """
+        PRIVATE method: compute the Coriolis parameter
+        """
+        if not self._has("f"):
             omega = 2 * np.pi * seapy.secs2day
             self.f = 2 * omega * np.sin(np.radians(self.lat_rho))
 
-        # Set the grid index coordinates
+    def _set_indices(self):
+        """
+        PRIVATE method: set the grid index coordinates
+        """
         self.I, self.J = np.meshgrid(
             np.arange(0, self.lm), np.arange(0, self.ln))
 
@@ -385,21 +790,20 @@ class grid:
         None : sets mask and h attributes in grid
 
         """
-        if hasattr(self, "mask_rho") or self.cgrid:
+        if self._has("mask_rho") or self.cgrid:
             return
         if fld is None and self.filename is not None:
-            if self._nc is None:
-                self._nc = seapy.netcdf(self.filename)
+            nc = seapy.netcdf(self.filename)
 
             # Try to load a field from the file
             for f in ["temp", "temperature", "water_temp", "fed"]:
-                if f in self._nc.variables:
-                    fld = self._nc.variables[f][0, :, :, :]
+                if f in nc.variables:
+                    fld = nc.variables[f][0, :, :, :]
                     fld = np.ma.array(fld, mask=np.isnan(fld))
                     break
 
             # Close the file
-            self._nc.close()
+            nc.close()
 
         # If we don't have a field to examine, then we cannot compute the
         # mask and bathymetry
@@ -417,9 +821,21 @@ class grid:
                 self.mask_rho[water] = 1.0
         self.mask_u = self.mask_v = self.mask_rho
 
+    def _set_stretching(self, force=False):
+        """
+        PRIVATE method: compute the ROMS stretching if it is not known
+        """
+        if self._isroms and (force or not self._has("s_rho") or
+                             not self._has("cs_r")):
+            self.s_rho, self.cs_r = seapy.roms.stretching(
+                self.vstretching, self.theta_s, self.theta_b,
+                self.hc, self.n)
+
     def set_depth(self, force=False):
         """
-        Compute the depth of each cell for the model grid.
+        Compute the depth of each cell for the model grid. The depths are
+        computed on first use, so calling this is only required to update
+        them.
 
         Parameters
         ----------
@@ -430,17 +846,22 @@ class grid:
         -------
         None : sets depth attributes in grid
         """
+        try:
+            self._set_stretching(force)
+        except (AttributeError, ValueError):
+            warn("could not compute grid depths.")
+            return
+        self._set_depth_rho()
+        self._set_depth_uv()
+
+    def _set_depth_rho(self):
+        """
+        PRIVATE method: compute the depths of the rho-grid cells
+        """
         try:
             if self._isroms:
-                if "s_rho" not in self.__dict__ or \
-                   "cs_r" not in self.__dict__ or force:
-                    self.s_rho, self.cs_r = seapy.roms.stretching(
-                        self.vstretching, self.theta_s, self.theta_b,
-                        self.hc, self.n)
                 self.depth_rho = seapy.roms.depth(
                     self.vtransform, self.h, self.hc, self.s_rho, self.cs_r)
-                self.depth_u = seapy.model.rho2u(self.depth_rho).filled(0)
-                self.depth_v = seapy.model.rho2v(self.depth_rho).filled(0)
             else:
                 d = self.z.copy()
                 l = np.nonzero(d > 0)
@@ -453,19 +874,29 @@ class grid:
                          self.lon_rho.shape[1]])
                 else:
                     self.depth_rho = self.z
-                if self.cgrid:
-                    self.depth_u = seapy.model.rho2u(self.depth_rho).filled(0)
-                    self.depth_v = seapy.model.rho2v(self.depth_rho).filled(0)
-                else:
-                    self.depth_u = self.depth_rho
-                    self.depth_v = self.depth_rho
         except (AttributeError, ValueError):
             warn("could not compute grid depths.")
             pass
 
+    def _set_depth_uv(self):
+        """
+        PRIVATE method: compute the depths of the u- and v-grid cells
+        """
+        try:
+            if self.cgrid:
+                self.depth_u = seapy.model.rho2u(self.depth_rho).filled(0)
+                self.depth_v = seapy.model.rho2v(self.depth_rho).filled(0)
+            else:
+                self.depth_u = self.depth_rho
+                self.depth_v = self.depth_rho
+        except (AttributeError, ValueError):
+            pass
+
     def set_thickness(self):
         """
-        Compute the thickness of each cell for the model grid.
+        Compute the thickness of each cell for the model grid. The
+        thicknesses are computed on first use, so calling this is only
+        required to update them.
 
         Parameters
         ----------
@@ -475,8 +906,13 @@ class grid:
         -------
         None : sets thick attributes in grid
         """
-        if "n" not in self.__dict__:
-            self.set_dims()
+        self._set_thick_rho()
+        self._set_thick_uv()
+
+    def _set_thick_rho(self):
+        """
+        PRIVATE method: compute the thickness of the rho-grid cells
+        """
         if self.n == 1:
             return
         try:
@@ -486,8 +922,6 @@ class grid:
                     self.n, w_grid=True)
                 self.thick_rho = seapy.roms.thickness(
                     self.vtransform, self.h, self.hc, s_w, cs_w)
-                self.thick_u = seapy.model.rho2u(self.thick_rho)
-                self.thick_v = seapy.model.rho2v(self.thick_rho)
             else:
                 d = np.abs(self.z.copy())
                 w = d * 0
@@ -504,16 +938,26 @@ class grid:
                                          np.ones(self.lon_rho.shape[0])).reshape(
                     [self.z.size, self.lon_rho.shape[0],
                      self.lon_rho.shape[1]])
-                if self.cgrid:
-                    self.thick_u = seapy.model.rho2u(self.thick_rho)
-                    self.thick_v = seapy.model.rho2v(self.thick_rho)
-                else:
-                    self.thick_u = self.thick_rho
-                    self.thick_v = self.thick_rho
         except AttributeError:
             warn("could not compute grid thicknesses.")
             pass
 
+    def _set_thick_uv(self):
+        """
+        PRIVATE method: compute the thickness of the u- and v-grid cells
+        """
+        if self.n == 1:
+            return
+        try:
+            if self.cgrid:
+                self.thick_u = seapy.model.rho2u(self.thick_rho)
+                self.thick_v = seapy.model.rho2v(self.thick_rho)
+            else:
+                self.thick_u = self.thick_rho
+                self.thick_v = self.thick_rho
+        except AttributeError:
+            pass
+
     def plot_trace(self, basemap=None, **kwargs):
         """
         Trace the boundary of the grid onto a map projection
@@ -635,6 +1079,113 @@ class grid:
             if hasattr(self, var.lower()):
                 nc.variables[var][:] = getattr(self, var.lower())
 
+    def save_snapshot(self, path):
+        """
+        Save all of the grid fields (both those from the file and those
+        derived, such as depth_rho and thick_u) into a snapshot directory.
+        Each array is stored as a .npy file with a JSON header, so that
+        the grid may be loaded quickly with from_snapshot, and the arrays
+        are memory-mapped and shared between processes.
+
+        Parameters
+        ----------
+        path : string
+            Name of the snapshot directory to create
+
+        Returns
+        -------
+        None
+
+        Examples
+        --------
+        >>> grid = seapy.model.asgrid("grid_file.nc")
+        >>> grid.save_snapshot("grid_snapshot")
+        >>> grid = seapy.model.grid.from_snapshot("grid_snapshot")
+        """
+        # Load and compute everything that is available
+        for var in list(self.key) + list(self._derived):
+            hasattr(self, var)
+
+        os.makedirs(path, exist_ok=True)
+        skip = ("key", "ijinterp", "llinterp")
+        attrs = {}
+        arrays = []
+        for var, val in self.__dict__.items():
+            if var.startswith("_") or var in skip:
+                continue
+            if isinstance(val, np.ndarray) and val.ndim > 0:
+                np.save(os.path.join(path, var + ".npy"), np.ma.getdata(val))
+                if np.ma.is_masked(val):
+                    np.save(os.path.join(path, var + ".mask.npy"),
+                            np.ma.getmaskarray(val))
+                arrays.append(var)
+            else:
+                attrs[var] = val.item() if isinstance(val, np.generic) or \
+                    isinstance(val, np.ndarray) else val
+
+        header = {"attributes": attrs,
+                  "arrays": arrays,
+                  "isroms": bool(self._isroms),
+                  "source": _file_identity(self.filename)}
+        with open(os.path.join(path, "header.json"), "w") as f:
+            json.dump(header, f, indent=1)
+
+    @classmethod
+    def from_snapshot(cls, path, check=True):
+        """
+        Load a grid from a snapshot directory created by save_snapshot. The
+        arrays are memory-mapped read-only, so the load time does not depend
+        upon the size of the grid and processes share the same memory. The
+        arrays are copy-on-write: changes are kept private to the process.
+
+        Parameters
+        ----------
+        path : string
+            Name of the snapshot directory
+        check : bool, optional
+            If True, warn if the source grid file has changed since the
+            snapshot was saved.
+
+        Returns
+        -------
+        seapy.model.grid
+
+        Examples
+        --------
+        >>> grid = seapy.model.grid.from_snapshot("grid_snapshot")
+        """
+        with open(os.path.join(path, "header.json"), "r") as f:
+            header = json.load(f)
+
+        if check and header["source"] is not None:
+            source = _file_identity(header["attributes"]["filename"],
+                                    header["source"])
+            if source is not None and \
+                    source["sha256"] != header["source"]["sha256"]:
+                warn("{:s} has changed since the snapshot {:s} was saved".format(
+                    str(header["attributes"]["filename"]), path))
+
+        new = cls.__new__(cls)
+        new.__dict__.update(
+            {k: tuple(v) if isinstance(v, list) else v
+             for k, v in header["attributes"].items()})
+        new.key = {}
+        new.ijinterp = None
+        new.llinterp = None
+        new._nc = None
+        new._source = None
+        new._isroms = header["isroms"]
+        new._depths = True
+        new._lazy_done = set()
+        for var in header["arrays"]:
+            fld = np.load(os.path.join(path, var + ".npy"), mmap_mode="c")
+            mask = os.path.join(path, var + ".mask.npy")
+            if os.path.exists(mask):
+                fld = np.ma.array(fld, mask=np.load(mask, mmap_mode="c"),
+                                  copy=False)
+            new.__dict__[var] = fld
+        return new
+
     def nearest(self, lon, lat, grid="rho"):
         """
         Find the indices nearest to each point in the given list of
@@ -656,13 +1207,19 @@ class grid:
             to the lon/lat points specified
         """
 
-        glat = getattr(self, "lat_" + grid)
-        glon = getattr(self, "lon_" + grid)
-        xy = np.dstack([glat.ravel(), glon.ravel()])[0]
-        pts = np.dstack([np.atleast_1d(lat), np.atleast_1d(lon)])[0]
-        grid_tree = scipy.spatial.cKDTree(xy)
-        dist, idx = grid_tree.query(pts)
-        return np.unravel_index(idx, glat.shape)
+        return self._index(grid).nearest(lon, lat)
+
+    def _index(self, grid="rho"):
+        """
+        PRIVATE method: return the spatial index of the given grid
+        staggering, building it on first use.
+        """
+        if self.ijinterp is None:
+            self.ijinterp = {}
+        if grid not in self.ijinterp:
+            self.ijinterp[grid] = _spatial_index(
+                getattr(self, "lon_" + grid), getattr(self, "lat_" + grid))
+        return self.ijinterp[grid]
 
     def ij(self, points):
         """
@@ -689,19 +1246,16 @@ class grid:
         >>> idx = g.ij(a)
         """
 
-        from seapy.external.hindices import hindices
-
         # Interpolate the lat/lons onto the I, J
-        xgrid, ygrid = np.ma.masked_equal(hindices(self.angle.T,
-                                                   self.lon_rho.T, self.lat_rho.T,
-                                                   points[0], points[1]), -999.0)
+        ygrid, xgrid = np.ma.masked_equal(self._index("rho").ij(
+            points[0], points[1], np.ma.getdata(self.angle)), -999.0)
         mask = self.mask_rho[(ygrid.filled(0).astype(int),
                               xgrid.filled(0).astype(int))]
         xgrid[mask == 0] = np.ma.masked
         ygrid[mask == 0] = np.ma.masked
         return (ygrid, xgrid)
 
-    def ijk(self, points, depth_adjust=False):
+    def ijk(self, points, depth_adjust=False, zeta=None, record=None):
         """
         Compute the fractional i, j, k indices of the grid from a
         set of lon, lat, depth points.
@@ -710,11 +1264,19 @@ class grid:
         ----------
         points : list of tuples,
             longitude, latitude, depth points to compute i, j, k indicies.
-            NOTE: depth is in meters (defaults to negative)
+            NOTE: depth is in meters (defaults to negative). Positive
+            depths are treated as negative; the given depths are not
+            modified.
         depth_adjust : bool,
             If True, depths that are deeper (shallower) than the grid are set
             to the bottom (top) layer, 0 (N). If False, a nan value is used for
             values beyond the grid depth. Default is False.
+        zeta : ndarray, optional
+            free-surface elevation [eta_rho, xi_rho] or
+            [record, eta_rho, xi_rho] to compute the depths of the ROMS grid
+            with. If not given, the depths of the grid at rest are used.
+        record : ndarray, optional
+            if zeta has records, the index of the record for each point
 
         Returns
         -------
@@ -727,37 +1289,27 @@ class grid:
         >>> idx = g.ijk(a)
 
         """
-        # NOTE: Attempted to use a 3D griddata, but it took over 2 minutes
-        # for each call, resulting in a 6minute runtime for this method
-        # Reverted to 2D i,j indices, then looping a 1-D interpolation
-        # to get depths for increased-speed (though this method is still slow)
-
-        from scipy.interpolate import interp1d
-
         # Get the i,j points
         (j, i) = self.ij((points[0], points[1]))
         k = j * np.ma.masked
-        grid_k = np.arange(0, self.n)
-        depth = np.asanyarray(points[2])
+        depth = np.array(points[2], dtype=float, ndmin=1)
         depth[depth > 0] *= -1
 
-        # Determine the unique points
+        # Locate the points within the column of the lower-left corner of
+        # their cell
         good = np.where(~np.logical_or(i.mask, j.mask))[0]
-        ii = np.floor(i[good]).astype(int)
-        jj = np.floor(j[good]).astype(int)
-        idx = seapy.unique_rows((jj, ii))
-        fill_value = 0 if depth_adjust else np.nan
-        for n in idx:
-            pts = np.where(np.logical_and(jj == jj[n], ii == ii[n]))
-            griddep = self.depth_rho[:, jj[n], ii[n]]
-            if griddep[0] < griddep[-1]:
-                griddep[-1] = 0.0
-            else:
-                griddep[0] = 0.0
-
-            fi = interp1d(griddep, grid_k, bounds_error=False,
-                          fill_value=fill_value)
-            k[good[pts]] = fi(depth[good][pts])
+        if good.size:
+            ii = np.floor(i[good]).astype(int)
+            jj = np.floor(j[good]).astype(int)
+            rec = None
+            if zeta is not None and np.ndim(zeta) == 3:
+                if record is None:
+                    raise ValueError(
+                        "record must be given with multiple zeta records")
+                rec = np.broadcast_to(record, depth.shape)[good]
+            k[good] = self._k_index(jj, ii, depth[good],
+                                    0 if depth_adjust else np.nan,
+                                    zeta, rec)
 
         # Mask bad points
         l = np.isnan(k.data)
@@ -767,6 +1319,56 @@ class grid:
 
         return (k, j, i)
 
+    def _k_index(self, jj, ii, depth, fill_value, zeta=None, record=None):
+        """
+        PRIVATE method: compute the fractional k index of each depth within
+        the rho-grid column (jj, ii) by linear interpolation of the depth
+        stack, with the top layer extended to the surface. All points are
+        located at once by searching each of the unique columns.
+        """
+        ncol = self.ln * self.lm
+        col = jj * self.lm + ii
+        if record is not None:
+            col = col + np.asanyarray(record, dtype=int) * ncol
+        cols, inv = np.unique(col, return_inverse=True)
+        rec, cj, ci = np.unravel_index(cols, (cols.max() // ncol + 1,
+                                              self.ln, self.lm))
+
+        # Build the depth stack of each column as [column, level]
+        if zeta is None:
+            stack = np.ma.getdata(self.depth_rho)[:, cj, ci].T.copy()
+            surface = 0.0
+        else:
+            if not self._isroms:
+                raise ValueError("zeta is only supported for ROMS grids")
+            zeta = np.ma.getdata(zeta)
+            surface = zeta[cj, ci] if zeta.ndim == 2 else zeta[rec, cj, ci]
+            stack = seapy.roms.depth(self.vtransform,
+                                     np.ma.getdata(self.h)[cj, ci],
+                                     self.hc, self.s_rho, self.cs_r,
+                                     zeta=surface).T
+        levels = np.tile(np.arange(self.n, dtype=float), (cols.size, 1))
+
+        # Order the columns to be increasing, with the top at the surface
+        flip = ~(stack[:, 0] < stack[:, -1])
+        stack[flip] = stack[flip, ::-1]
+        levels[flip] = levels[flip, ::-1]
+        stack[:, -1] = surface
+
+        # Linearly interpolate between the levels that bracket each depth
+        stack = stack[inv]
+        levels = levels[inv]
+        pts = np.arange(depth.size)
+        hi = np.clip(np.sum(stack < depth[:, np.newaxis], axis=1),
+                     1, self.n - 1)
+        lo = hi - 1
+        slope = (levels[pts, hi] - levels[pts, lo]) / \
+            (stack[pts, hi] - stack[pts, lo])
+        k = slope * (depth - stack[pts, lo]) + levels[pts, lo]
+        k[np.logical_or(depth < stack[:, 0], depth > stack[:, -1])] = \
+            fill_value
+        return k
+
     def latlon(self, indices):
         """
         Compute the latitude and longitude from the given (i,j) indices
@@ -789,10 +1391,11 @@ class grid:
         """
         from scipy.interpolate import RegularGridInterpolator
 
-        lati = RegularGridInterpolator((self.I[0, :], self.J[:, 0]),
-                                       self.lat_rho.T)
-        loni = RegularGridInterpolator((self.I[0, :], self.J[:, 0]),
-                                       self.lon_rho.T)
+        if self.llinterp is None:
+            ij = (np.arange(self.lm), np.arange(self.ln))
+            self.llinterp = (RegularGridInterpolator(ij, self.lat_rho.T),
+                             RegularGridInterpolator(ij, self.lon_rho.T))
+        lati, loni = self.llinterp
 
         return (lati(indices), loni(indices))
 
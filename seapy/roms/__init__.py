@@ -8,12 +8,14 @@
   Imported functions include:
 
   - :func:`~seapy.roms.lib.depth`
+  - :func:`~seapy.roms.lib.depth_records`
   - :func:`~seapy.roms.lib.get_reftime`
   - :func:`~seapy.roms.lib.date2num`
   - :func:`~seapy.roms.lib.num2date`
   - :func:`~seapy.roms.lib.get_timevar`
   - :func:`~seapy.roms.lib.stretching`
   - :func:`~seapy.roms.lib.thickness`
+  - :func:`~seapy.roms.lib.thickness_records`
 """
 from . import analysis
 from . import boundary
@@ -9,25 +9,22 @@
 """
 
 import numpy as np
+import scipy.sparse
+import matplotlib.path
 from joblib import Parallel, delayed
 import seapy
 import netCDF4
 from rich.progress import track
+from warnings import warn
 
 
-def __find_surface_thread(grid, field, value, zeta, const_depth=False,
-                          k_values=False, u_grid=False, v_grid=False):
+def __find_surface_block(field, depth, value, const_depth=False,
+                         k_values=False):
     """
     Internal function to find a value in field_a and return the
-    values from field_b at the same positions.
+    values from field_b at the same positions for a block of records
+    [record, N, eta, xi] at once.
     """
-    depth = seapy.roms.depth(grid.vtransform, grid.h, grid.hc,
-                             grid.s_rho, grid.cs_r, zeta)
-    if u_grid:
-        depth = seapy.model.rho2u(depth)
-    elif v_grid:
-        depth = seapy.model.rho2v(depth)
-
     # Set the variables based on what we are finding
     if const_depth:
         field_a, field_b = depth, field
@@ -36,103 +33,160 @@ def __find_surface_thread(grid, field, value, zeta, const_depth=False,
 
     # Determine the upper and lower bounds of the value in the field
     tmp = np.ma.masked_equal(
-        np.diff(((field_a - value) < 0).astype(np.short), axis=0), 0)
-    factor = -np.sign(np.mean(np.diff(field, axis=0))).astype(np.short)
+        np.diff(((field_a - value) < 0).astype(np.short), axis=1), 0)
+    factor = -np.sign(np.mean(np.diff(field, axis=1),
+                              axis=(1, 2, 3))).astype(np.short)
+    factor = factor[:, np.newaxis, np.newaxis, np.newaxis]
 
     # Determine the points of the upper bound and the lower bound
-    bad = np.sum(tmp, axis=0).astype(bool)
-    k_ones = np.arange(grid.n, dtype=np.short)
-    upper = (k_ones[:, np.newaxis, np.newaxis] ==
-             np.argmax(np.abs(tmp), axis=0)) * bad
-    k_ones = np.arange(grid.n, dtype=np.short) - factor
-    lower = (k_ones[:, np.newaxis, np.newaxis] ==
-             np.argmax(np.abs(tmp), axis=0)) * bad
+    bad = np.sum(tmp, axis=1).astype(bool)[:, np.newaxis, ...]
+    kmax = np.argmax(np.abs(tmp), axis=1)[:, np.newaxis, ...]
+    k_ones = np.arange(field.shape[1],
+                       dtype=np.short)[np.newaxis, :, np.newaxis, np.newaxis]
+    upper = (k_ones == kmax) * bad
+    lower = ((k_ones - factor) == kmax) * bad
 
     # Now that we have the bounds, we can linearly interpolate to
     # find where the value lies
-    u_a = np.sum(field_a * upper, axis=0)
-    d_a = u_a - np.sum(field_a * lower, axis=0)
+    u_a = np.sum(field_a * upper, axis=1)
+    d_a = u_a - np.sum(field_a * lower, axis=1)
     d_z = (u_a - value) / d_a
     if k_values:
-        return np.argmax(upper, axis=0) + factor * d_z
+        return np.argmax(upper, axis=1) + factor[:, 0, ...] * d_z
 
     # Calculate the values from field_b
-    u_b = np.sum(field_b * upper, axis=0)
-    d_b = u_b - np.sum(field_b * lower, axis=0)
+    u_b = np.sum(field_b * upper, axis=1)
+    d_b = u_b - np.sum(field_b * lower, axis=1)
     return u_b - d_b * d_z
 
 
-def constant_depth(field, grid, depth, zeta=None, threads=2):
+def __find_surface(field, grid, value, zeta, threads, chunk, output,
+                   **kwargs):
+    """
+    Internal function to find the surface of the value through all
+    records of the field, computing blocks of records at once. The field
+    and zeta may be arrays or netCDF variables, which are read one block
+    at a time.
+    """
+    if np.ndim(field) == 3:
+        field = seapy.adddim(field[:])
+    nt = field.shape[0]
+    if zeta is not None and np.ndim(zeta) == 2:
+        zeta = seapy.adddim(zeta[:], nt)
+
+    # Determine the grid of the field
+    if field.shape[-2:] == grid.mask_u.shape:
+        c_grid = seapy.model.rho2u
+    elif field.shape[-2:] == grid.mask_v.shape:
+        c_grid = seapy.model.rho2v
+    else:
+        def c_grid(depth):
+            return depth
+
+    # If there is no free-surface, the depths are the same for all records
+    depth = None
+    if zeta is None:
+        depth = c_grid(seapy.roms.depth(grid.vtransform, grid.h, grid.hc,
+                                        grid.s_rho, grid.cs_r))[np.newaxis]
+
+    def compute(fld, z):
+        dep = depth if z is None else c_grid(seapy.roms.depth(
+            grid.vtransform, grid.h, grid.hc, grid.s_rho, grid.cs_r, z))
+        return __find_surface_block(np.ma.masked_invalid(fld, copy=False),
+                                    dep, value, **kwargs)
+
+    # Process the blocks of records. Each group of blocks is read serially
+    # and computed in parallel threads that share the grid arrays.
+    threads = int(max(1, np.minimum(np.ceil(nt / chunk), threads)))
+    nfield = None if output is not None else \
+        np.ma.zeros((nt,) + field.shape[-2:])
+    for n in track(range(0, nt, chunk * threads), total=np.ceil(
+            nt / chunk / threads), description="find surface"):
+        blocks = [slice(b, min(b + chunk, nt))
+                  for b in range(n, min(n + chunk * threads, nt), chunk)]
+        data = [(field[l], None if zeta is None else zeta[l])
+                for l in blocks]
+        vals = Parallel(n_jobs=threads, prefer="threads")(
+            delayed(compute)(*d) for d in data)
+        for l, val in zip(blocks, vals):
+            if output is None:
+                nfield[l] = val
+            else:
+                output[l] = val
+    return nfield
+
+
+def constant_depth(field, grid, depth, zeta=None, threads=2, chunk=10,
+                   output=None):
     """
     Find the values of a 3-D field at a constant depth for all times given.
 
     Parameters
     ----------
-    field : ndarray,
+    field : ndarray or netCDF4.Variable,
         ROMS 3-D field to interpolate onto a constant depth level. If 4-D, it
         will calculate through time.
     grid : seapy.model.grid or string or list,
         Grid that defines the depths and stretching for the field given
     depth : float,
         Depth (in meters) to find all values
-    zeta : ndarray, optional,
+    zeta : ndarray or netCDF4.Variable, optional,
         ROMS zeta field corresponding to field if you wish to apply the SSH
         correction to the depth calculations.
     threads : int, optional,
         Number of threads to use for processing
+    chunk : int, optional,
+        Number of records to process at a time
+    output : netCDF4.Variable, optional,
+        Variable [time, eta, xi] to write the results of each chunk of
+        records into. If given, the results are not returned.
 
     Returns
     -------
     nfield : ndarray,
         Values from ROMS field on the given constant depth
+
+    Examples
+    --------
+    >>> nc = netCDF4.Dataset("ocean_his.nc")
+    >>> temp100 = seapy.roms.analysis.constant_depth(
+    ...     nc.variables["temp"], grid, 100, zeta=nc.variables["zeta"])
     """
     grid = seapy.model.asgrid(grid)
-    field = np.ma.masked_invalid(field, copy=False)
     depth = depth if depth < 0 else -depth
     if depth is None or grid.depth_rho.min() > depth > grid.depth_rho.max():
-        warn("Error: {:f} is out of range for the depth.".format(value))
+        warn("Error: {:f} is out of range for the depth.".format(depth))
         return
-    if np.ndim(field) == 3:
-        field = seapy.adddim(field)
-    nt = field.shape[0]
-    threads = np.minimum(nt, threads)
-    if zeta is None:
-        zeta = np.zeros((nt, 1, 1))
-    if np.ndim(zeta) == 2:
-        zeta = seapy.adddim(zeta, nt)
-
-    v_grid = u_grid = False
-    if field.shape[-2:] == grid.mask_u:
-        u_grid = True
-    elif field.shape[-2:] == grid.mask_v:
-        v_grid = True
 
-    return np.ma.array(Parallel(n_jobs=threads, verbose=2)
-                       (delayed(__find_surface_thread)
-                        (grid, field[i, :], depth, zeta[i, :],
-                         const_depth=True, u_grid=u_grid, v_grid=v_grid)
-                        for i in range(nt)), copy=False)
+    return __find_surface(field, grid, depth, zeta, threads, chunk, output,
+                          const_depth=True)
 
 
-def constant_value(field, grid, value, zeta=None, threads=2):
+def constant_value(field, grid, value, zeta=None, threads=2, chunk=10,
+                   output=None):
     """
     Find the depth of the value across the field. For example, find the depth
     of a given isopycnal if the field is density.
 
     Parameters
     ----------
-    field : ndarray,
+    field : ndarray or netCDF4.Variable,
         ROMS 3-D field to interpolate onto a constant depth level. If 4-D, it
         will calculate through time.
     grid : seapy.model.grid or string or list,
         Grid that defines the depths and stretching for the field given
     value : float,
         Value to find the depths for in same units as the 'field'
-    zeta : ndarray, optional,
+    zeta : ndarray or netCDF4.Variable, optional,
         ROMS zeta field corresponding to field if you wish to apply the SSH
         correction to the depth calculations.
     threads : int, optional,
         Number of threads to use for processing
+    chunk : int, optional,
+        Number of records to process at a time
+    output : netCDF4.Variable, optional,
+        Variable [time, eta, xi] to write the results of each chunk of
+        records into. If given, the results are not returned.
 
     Returns
     -------
@@ -140,48 +194,39 @@ def constant_value(field, grid, value, zeta=None, threads=2):
         Depths from ROMS field on the given value
     """
     grid = seapy.model.asgrid(grid)
-    field = np.ma.masked_invalid(field, copy=False)
-    if value is None or field.min() > value > field.max():
+    if value is None or (isinstance(field, np.ndarray) and
+                         field.min() > value > field.max()):
         warn("Error: {:f} is out of range for the field.".format(value))
         return
-    if np.ndim(field) == 3:
-        field = seapy.adddim(field)
-    nt = field.shape[0]
-    threads = np.minimum(nt, threads)
-    if zeta is None:
-        zeta = np.zeros((nt, 1, 1))
-    if np.ndim(zeta) == 2:
-        zeta = seapy.adddim(zeta, nt)
-
-    v_grid = u_grid = False
-    if field.shape[-2:] == grid.mask_u:
-        u_grid = True
-    elif field.shape[-2:] == grid.mask_v:
-        v_grid = True
 
-    return np.ma.array(Parallel(n_jobs=threads, verbose=2)
-                       (delayed(__find_surface_thread)
-                        (grid, field[i, :], value, zeta[i, :],
-                         u_grid=u_grid, v_grid=v_grid)
-                        for i in range(nt)), copy=False)
+    return __find_surface(field, grid, value, zeta, threads, chunk, output)
 
 
-def constant_value_k(field, grid, value, zeta=None, threads=2):
+def constant_value_k(field, grid, value, zeta=None, threads=2, chunk=10,
+                     output=None):
     """
     Find the layer number of the value across the field. For example, find the k
     of a given isopycnal if the field is density.
 
     Parameters
     ----------
-    field : ndarray,
+    field : ndarray or netCDF4.Variable,
         ROMS 3-D field to interpolate onto a constant depth level. If 4-D, it
         will calculate through time.
     grid : seapy.model.grid or string or list,
         Grid that defines the depths and stretching for the field given
     value : float,
         Value to find the depths for in same units as the 'field'
+    zeta : ndarray or netCDF4.Variable, optional,
+        ROMS zeta field corresponding to field if you wish to apply the SSH
+        correction to the depth calculations.
     threads : int, optional,
         Number of threads to use for processing
+    chunk : int, optional,
+        Number of records to process at a time
+    output : netCDF4.Variable, optional,
+        Variable [time, eta, xi] to write the results of each chunk of
+        records into. If given, the results are not returned.
 
     Returns
     -------
@@ -189,30 +234,73 @@ def constant_value_k(field, grid, value, zeta=None, threads=2):
         Depths from ROMS field on the given value
     """
     grid = seapy.model.asgrid(grid)
-    field = np.ma.masked_invalid(field, copy=False)
-    if value is None or field.min() > value > field.max():
+    if value is None or (isinstance(field, np.ndarray) and
+                         field.min() > value > field.max()):
         warn("Error: {:f} is out of range for the field.".format(value))
         return
-    if np.ndim(field) == 3:
-        field = seapy.adddim(field)
-    nt = field.shape[0]
-    threads = np.minimum(nt, threads)
+
+    return __find_surface(field, grid, value, zeta, threads, chunk, output,
+                          k_values=True)
+
+
+def __depth_weights(grid, bottom, top, zeta=None, c_grid=None):
+    """
+    Internal function to compute the thickness of the layers between the
+    bottom and top depths, which are the weights of the depth average. If
+    zeta has records, the weights are [record, N, eta, xi].
+    """
     if zeta is None:
-        zeta = np.zeros((nt, 1, 1))
-    if np.ndim(zeta) == 2:
-        zeta = seapy.adddim(zeta, nt)
+        depths = np.ma.masked_equal(grid.depth_rho * grid.mask_rho, 0)
+        thickness = np.ma.masked_equal(grid.thick_rho * grid.mask_rho, 0)
+    else:
+        s_w, cs_w = seapy.roms.stretching(grid.vstretching, grid.theta_s,
+                                          grid.theta_b, grid.hc,
+                                          grid.n, w_grid=True)
+        depths = np.ma.masked_equal(seapy.roms.depth(
+            grid.vtransform, grid.h, grid.hc, grid.s_rho, grid.cs_r, zeta) *
+            grid.mask_rho, 0)
+        thickness = np.ma.masked_equal(seapy.roms.thickness(
+            grid.vtransform, grid.h, grid.hc, s_w, cs_w, zeta) *
+            grid.mask_rho, 0)
+
+    # If we are on u- or v-grid, transform
+    if c_grid is not None:
+        depths = c_grid(depths)
+        thickness = c_grid(thickness)
+
+    # Pick all of the layers between the nearest layers to the limits
+    k_ones = np.arange(grid.n, dtype=int)[:, np.newaxis, np.newaxis]
+    top = depths[..., -1:, :, :] if top == 0 else top
+    upper = depths - top
+    upper[np.where(upper < 0)] = np.inf
+    lower = depths - bottom
+    lower[np.where(lower > 0)] = -np.inf
+    return thickness * np.ma.masked_equal(np.logical_and(
+        k_ones <= np.argmin(upper, axis=-3)[..., np.newaxis, :, :],
+        k_ones >= np.argmax(lower, axis=-3)[..., np.newaxis, :, :]).astype(
+        int), 0)
+
+
+def __depth_limits(bottom, top):
+    """
+    Internal function to return the bottom and top depths as negative
+    values in order
+    """
+    bottom = bottom if bottom < 0 else -bottom
+    top = top if top < 0 else -top
+    return (top, bottom) if bottom > top else (bottom, top)
 
-    v_grid = u_grid = False
-    if field.shape[-2:] == grid.mask_u:
-        u_grid = True
-    elif field.shape[-2:] == grid.mask_v:
-        v_grid = True
 
-    return np.ma.array(Parallel(n_jobs=threads, verbose=2)
-                       (delayed(__find_surface_thread)
-                        (grid, field[i, :], value, zeta[i, :],
-                         k_values=True, u_grid=u_grid, v_grid=v_grid)
-                        for i in range(nt)), copy=False)
+def __c_grid(grid, shape):
+    """
+    Internal function to return the function to transform rho-grid fields
+    onto the grid of a field of the given shape, or None for the rho-grid.
+    """
+    if tuple(shape[-2:]) == grid.mask_u.shape:
+        return seapy.model.rho2u
+    elif tuple(shape[-2:]) == grid.mask_v.shape:
+        return seapy.model.rho2v
+    return None
 
 
 def depth_average(field, grid, bottom, top, zeta=None):
@@ -224,17 +312,19 @@ def depth_average(field, grid, bottom, top, zeta=None):
     Parameters
     ----------
     field : ndarray,
-        ROMS 3-D field to integrate from a depth level. Must be
-        three-dimensional array (single time).
+        ROMS 3-D field to integrate from a depth level. If 4-D, the average
+        of each record is computed.
     grid : seapy.model.grid or string or list,
         Grid that defines the depths and stretching for the field given
     bottom : float,
         Depth (in meters) to integrate from
     top : float,
-        Depth (in meters) to integrate to
+        Depth (in meters) to integrate to. If zero, integrate to the
+        surface.
     zeta : ndarray, optional,
         ROMS zeta field corresponding to field if you wish to apply the SSH
-        correction to the depth calculations.
+        correction to the depth calculations. If field is 4-D, zeta may
+        have the same records.
 
     Returns
     -------
@@ -242,52 +332,123 @@ def depth_average(field, grid, bottom, top, zeta=None):
         Values from depth integrated ROMS field
     """
     grid = seapy.model.asgrid(grid)
-    bottom = bottom if bottom < 0 else -bottom
-    top = top if top < 0 else -top
-    if bottom > top:
-        bottom, top = top, bottom
-    drange = top - bottom
+    bottom, top = __depth_limits(bottom, top)
+    weights = __depth_weights(grid, bottom, top, zeta,
+                              __c_grid(grid, np.shape(field)))
 
-    # If we have zeta, we need to compute thickness
-    if zeta is not None:
-        s_w, cs_w = seapy.roms.stretching(grid.vstretching, grid.theta_s,
-                                          grid.theta_b, grid.hc,
-                                          grid.n, w_grid=True)
-        depths = np.ma.masked_equal(seapy.roms.depth(
-            grid.vtransform, grid.h, grid.hc, grid.s_rho, grid.cs_r) *
-            grid.mask_rho, 0)
+    # Do the integration
+    return np.sum(field * weights, axis=-3) / np.sum(weights, axis=-3)
 
-        thickness = np.ma.masked_array(seapy.roms.thickness(
-            grid.vtransform, grid.h, grid.hc, s_w, cs_w, zeta) *
-            grid.mask_rho, 0)
 
-    else:
-        depths = np.ma.masked_equal(grid.depth_rho * grid.mask_rho, 0)
-        thickness = np.ma.masked_equal(grid.thick_rho * grid.mask_rho, 0)
+def gen_depth_average(roms_file, avg_file, bottom, top, fields=None,
+                      records=None, zeta=True, chunk=10, clobber=False):
+    """
+    Compute the depth-average of many fields for the records of a ROMS
+    history (or average) file and store them into a new file. The layer
+    weights are computed once for the grid (or once per chunk of records
+    when using zeta), and are shared by all fields of the same grid. The
+    records are read, averaged, and written in chunks, so the full 4D fields
+    are never held in memory.
 
-    # If we are on u- or v-grid, transform
-    if field.shape == grid.thick_u.shape:
-        depths = seapy.model.rho2u(depths)
-        thickness = seapy.model.rho2u(thickness)
-    elif field.shape == grid.thick_v.shape:
-        depths = seapy.model.rho2v(depths)
-        thickness = seapy.model.rho2v(thickness)
-
-    # 1. pick all of the points that are deeper and shallower than the limits
-    k_ones = np.arange(grid.n, dtype=int)
-    top_depth = depths[-1, :, :] if top_depth == 0 else top_depth
-    upper = depths - top_depth
-    upper[np.where(upper < 0)] = np.float('inf')
-    lower = depths - depth
-    lower[np.where(lower > 0)] = -np.float('inf')
-    thickness *= np.ma.masked_equal(np.logical_and(
-        k_ones[:, np.newaxis, np.newaxis] <= np.argmin(upper, axis=0),
-        k_ones[:, np.newaxis, np.newaxis] >=
-        np.argmax(lower, axis=0)).astype(int), 0)
+    Parameters
+    ----------
+    roms_file: string or list of strings,
+        The ROMS (history or average) file from which to compute the
+        averages. If it is a list of strings, a netCDF4.MFDataset is opened
+        instead.
+    avg_file: string,
+        The name of the file to store the depth-averaged fields
+    bottom : float,
+        Depth (in meters) to integrate from
+    top : float,
+        Depth (in meters) to integrate to. If zero, integrate to the
+        surface.
+    fields: list of str, optional
+        The 3-D fields to average. Default is to use the ROMS 3-D
+        prognostic variables (u, v, temp, salt) in the file.
+    records: ndarray, optional
+        List of records to average. Default is all records.
+    zeta: bool, optional
+        If True (default) and zeta is in the file, apply the SSH correction
+        to the depths of each record.
+    chunk: int, optional
+        The number of records to average at a time
+    clobber: bool, optional
+        If True, clobber any existing avg_file
 
-    # Do the integration
-    return np.sum(field * thickness, axis=0) / \
-        np.sum(thickness, axis=0)
+    Returns
+    -------
+        None
+
+    Examples
+    --------
+    >>> seapy.roms.analysis.gen_depth_average("ocean_his.nc",
+    ...                                       "ocean_top100.nc", 100, 0)
+    """
+    # Open the ROMS info
+    grid = seapy.model.asgrid(roms_file)
+    nc = seapy.netcdf(roms_file)
+    bottom, top = __depth_limits(bottom, top)
+    if fields is None:
+        fields = [f for f in seapy.roms.fields
+                  if seapy.roms.fields[f]["dims"] == 3]
+    fields = [f for f in fields
+              if f in nc.variables and nc.variables[f].ndim == 4]
+    zeta = zeta and "zeta" in nc.variables
+    epoch, time_var = seapy.roms.get_reftime(nc)
+    if records is None:
+        records = np.arange(len(nc.variables[time_var]))
+    else:
+        records = np.atleast_1d(records)
+
+    # Build the output file with each field on its own grid
+    c_grids = {}
+    dims = {"ocean_time": 0}
+    vars = [{"name": "ocean_time", "type": "f8",
+             "dims": "ocean_time",
+             "attr": {"long_name": "time since initialization",
+                      "units": "seconds since " + str(epoch)}}]
+    for f in fields:
+        c_grids[f] = __c_grid(grid, nc.variables[f].shape)
+        stagger = {seapy.model.rho2u: "u",
+                   seapy.model.rho2v: "v"}.get(c_grids[f], "rho")
+        shp = getattr(grid, "mask_" + stagger).shape
+        dims["eta_" + stagger], dims["xi_" + stagger] = shp
+        attr = {a: nc.variables[f].getncattr(a) for a in ("long_name", "units")
+                if a in nc.variables[f].ncattrs()}
+        attr["depth_range"] = "{:f} to {:f} meter".format(bottom, top)
+        vars.append({"name": f, "type": "f4",
+                     "dims": "ocean_time, eta_{0}, xi_{0}".format(stagger),
+                     "attr": attr})
+    ncout = seapy.roms.ncgen.ncgen(avg_file, dims=dims, vars=vars,
+                                   clobber=clobber,
+                                   title="depth average from {:s}".format(
+                                       str(roms_file)))
+    start = len(ncout.variables["ocean_time"])
+
+    # Average each chunk of records
+    weights = {}
+    for n in track(range(0, records.size, chunk),
+                   description="compute depth average"):
+        recs = records[n:n + chunk]
+        out = slice(start + n, start + n + recs.size)
+        ncout.variables["ocean_time"][out] = seapy.roms.date2num(
+            seapy.roms.num2date(nc, time_var, recs), ncout, "ocean_time")
+        if zeta:
+            z = nc.variables["zeta"][recs, ...]
+            weights = {}
+        for f in fields:
+            c_grid = c_grids[f]
+            if c_grid not in weights:
+                weights[c_grid] = __depth_weights(
+                    grid, bottom, top, z if zeta else None, c_grid)
+            w = weights[c_grid]
+            ncout.variables[f][out, ...] = \
+                np.sum(nc.variables[f][recs, ...] * w, axis=-3) / \
+                np.sum(w, axis=-3)
+        ncout.sync()
+    ncout.close()
+    nc.close()
 
 
 def transect(lon, lat, depth, data, nx=200, nz=40, z=None):
@@ -395,12 +556,1008 @@ def transect(lon, lat, depth, data, nx=200, nz=40, z=None):
     return x, z, ndat
 
 
-def gen_std_i(roms_file, std_file, std_window=5, pad=1, skip=30, fields=None):
+def _bilinear(grid, j, i, stagger):
+    """
+    Internal function to compute the bilinear weights [point, 4] and the
+    indices of the surrounding wet points of the given staggered grid
+    ("rho", "u", or "v") for fractional rho-grid indices. Points outside of
+    the grid (negative indices) or surrounded by land have zero weights.
+    """
+    mask = np.ma.getdata(getattr(grid, "mask_" + stagger))
+    ln, lm = mask.shape
+    jj = j - (0.5 if stagger == "v" else 0.0)
+    ii = i - (0.5 if stagger == "u" else 0.0)
+    j0 = np.clip(np.floor(jj), 0, ln - 2).astype(int)
+    i0 = np.clip(np.floor(ii), 0, lm - 2).astype(int)
+    fj = np.clip(jj - j0, 0, 1)
+    fi = np.clip(ii - i0, 0, 1)
+    jc = np.stack((j0, j0, j0 + 1, j0 + 1), axis=1)
+    ic = np.stack((i0, i0 + 1, i0, i0 + 1), axis=1)
+    w = np.stack(((1 - fj) * (1 - fi), (1 - fj) * fi,
+                  fj * (1 - fi), fj * fi), axis=1) * mask[jc, ic]
+    w[np.logical_or(j < 0, i < 0)] = 0
+    total = w.sum(axis=1)
+    w[total > 0] /= total[total > 0, np.newaxis]
+    return w, jc, ic
+
+
+class grid_transect:
+    """
+    Transect through a ROMS grid along a path of longitude/latitude points.
+    The interpolation weights from the grid onto the equidistant points of
+    the transect are computed once and stored as a sparse matrix, so that
+    any number of fields or records may be interpolated with a single
+    sparse product.
+
+    The horizontal weights are bilinear between the (wet) grid points
+    surrounding each point, and the vertical weights are linear between the
+    layers. Values above the top layer take the top layer value, and points
+    below the bottom layer or outside of the grid are masked. The depths
+    of the grid at rest are used.
+
+    Parameters
+    ----------
+    grid : seapy.model.grid or string or list,
+        Grid of the fields to interpolate
+    lon : array,
+        Longitudes of the points defining the path of the transect
+    lat : array,
+        Latitudes of the points defining the path of the transect
+    nx : int, optional
+        number of horizontal points desired in the transect
+    nz : int, optional
+        number of vertical points desired in the transect
+    z : array, optional
+        list of depths to use if you do not want equidistant depths
+
+    Attributes
+    ----------
+    x : array
+        x-location values in [m] along transect
+    z : array
+        depth values in [m] of the transect
+    lon, lat : array
+        location of each x-location
+
+    Examples
+    --------
+    Generate series of transects from ROMS output
+
+    >>> nc = seapy.netcdf('roms_his.nc')
+    >>> tr = seapy.roms.analysis.grid_transect(nc.filepath(),
+    ...                                        [-158, -157], [21, 22])
+    >>> salt = tr.interpolate(nc.variables['salt'][:])
+    >>> plt.pcolormesh(tr.x / 1000, tr.z, salt[0, :, :])
+    """
+
+    def __init__(self, grid, lon, lat, nx=200, nz=40, z=None):
+        self.grid = seapy.model.asgrid(grid)
+        lon = np.atleast_1d(lon).astype(float)
+        lat = np.atleast_1d(lat).astype(float)
+
+        # Sample the path at equal distances
+        dist = np.hstack(([0], np.cumsum(seapy.earth_distance(
+            lon[:-1], lat[:-1], lon[1:], lat[1:]))))
+        self.x = np.linspace(0, dist[-1], nx)
+        self.lon = np.interp(self.x, dist, lon)
+        self.lat = np.interp(self.x, dist, lat)
+
+        # Find the fractional grid indices of the points
+        self._j, self._i = self.grid._index("rho").ij(
+            self.lon, self.lat, np.ma.getdata(self.grid.angle))
+
+        if z is None:
+            j, i = self._j[self._j >= 0], self._i[self._i >= 0]
+            hmax = self.grid.h[np.round(j).astype(int),
+                               np.round(i).astype(int)].max() \
+                if j.size else self.grid.h.max()
+            self.z = np.linspace(-hmax, 0, nz)
+        else:
+            self.z = -np.abs(np.atleast_1d(z).astype(float))
+        self._weights = {}
+
+    def _horizontal(self, grid):
+        """
+        PRIVATE method: compute the bilinear weights [point, 4] and the
+        flat indices of the surrounding wet points of the given staggered
+        grid for each point of the transect
+        """
+        w, j, i = _bilinear(self.grid, self._j, self._i, grid)
+        return w, j * getattr(self.grid, "mask_" + grid).shape[1] + i
+
+    def _matrix(self, grid):
+        """
+        PRIVATE method: build the sparse interpolation matrix and the mask
+        of the transect for the given staggered grid
+        """
+        if grid in self._weights:
+            return self._weights[grid]
+        w, cells = self._horizontal(grid)
+        ncell = getattr(self.grid, "mask_" + grid).size
+        depth = np.ma.getdata(getattr(self.grid, "depth_" + grid)).reshape(
+            self.grid.n, -1)
+        nz, nx = self.z.size, self.x.size
+
+        # Depths of the layers at each point, ordered from the bottom
+        levels = np.arange(self.grid.n)
+        if depth[0, 0] > depth[-1, 0]:
+            levels = levels[::-1]
+        dcol = np.einsum("pc,kpc->pk", w, depth[levels][:, cells])
+
+        # Find the layers bracketing each depth
+        z = self.z[:, np.newaxis]
+        hi = np.clip(np.sum(dcol[np.newaxis, :, :] < z[..., np.newaxis],
+                            axis=2), 1, self.grid.n - 1)
+        lo = hi - 1
+        pts = np.arange(nx)[np.newaxis, :]
+        dlo, dhi = dcol[pts, lo], dcol[pts, hi]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fk = np.clip((z - dlo) / (dhi - dlo), 0, 1)
+        mask = np.logical_or(z < dcol[:, 0][np.newaxis, :],
+                             (w.sum(axis=1) == 0)[np.newaxis, :])
+
+        # Combine the vertical and horizontal weights of each transect point
+        row = np.arange(nz * nx).reshape(nz, nx)
+        rows, cols, vals = [], [], []
+        for k, f in ((lo, 1 - fk), (hi, fk)):
+            rows.append(np.broadcast_to(row[..., np.newaxis], (nz, nx, 4)))
+            cols.append(levels[k][..., np.newaxis] * ncell + cells[pts])
+            vals.append(np.where(mask, 0, f)[..., np.newaxis] *
+                        w[np.newaxis, :, :])
+        mat = scipy.sparse.csr_matrix(
+            (np.concatenate(vals, axis=None),
+             (np.concatenate(rows, axis=None),
+              np.concatenate(cols, axis=None))),
+            shape=(nz * nx, self.grid.n * ncell))
+        mat.eliminate_zeros()
+        self._weights[grid] = (mat, mask)
+        return self._weights[grid]
+
+    def interpolate(self, field):
+        """
+        Interpolate the field onto the transect
+
+        Parameters
+        ----------
+        field : ndarray,
+            ROMS 3-D field [N, eta, xi] on the rho, u, or v grid. If it has
+            leading dimensions (e.g., time), every record is interpolated.
+
+        Returns
+        -------
+        vals: np.ma.array
+            data values of the transect [..., nz, nx] with masked values
+        """
+        field = np.ma.asanyarray(field)
+        shp = field.shape[-2:]
+        grid = "rho"
+        if shp == self.grid.mask_u.shape:
+            grid = "u"
+        elif shp == self.grid.mask_v.shape:
+            grid = "v"
+        mat, mask = self._matrix(grid)
+        lead = field.shape[:-3]
+        data = field.reshape(-1, mat.shape[1]).filled(0)
+        vals = mat.dot(data.T).T.reshape(lead + mask.shape)
+        return np.ma.array(vals, mask=np.broadcast_to(mask, vals.shape))
+
+
+class grid_stations:
+    """
+    Time-series extraction at stations (e.g., moorings or tide gauges) from
+    ROMS fields. The bilinear stencil of each station is computed once for
+    each staggered grid, and only the grid cells of the stencils are read
+    from the netCDF variables: either a single hyperslab bounding all of the
+    stations when they are clustered, or one 2x2 hyperslab for each group of
+    stations sharing a stencil. The stencils are then applied to all of the
+    records at once.
+
+    If depths are given, the 3-D fields are also interpolated linearly
+    between the layers (using the depths of the grid at rest) to the depth
+    of each station. Stations above the top layer take the top layer value,
+    and those below the bottom layer take the bottom layer value unless they
+    are deeper than the bottom, in which case they are masked. Stations
+    outside of the grid or surrounded by land are masked.
+
+    Parameters
+    ----------
+    grid : seapy.model.grid or string or list,
+        Grid of the fields to extract
+    lon : array,
+        Longitudes of the stations
+    lat : array,
+        Latitudes of the stations
+    depth : float or array, optional
+        Depth (in meters) of each station. If not given, the 3-D fields are
+        extracted at every layer.
+
+    Examples
+    --------
+    >>> nc = seapy.netcdf('roms_his.nc')
+    >>> sta = seapy.roms.analysis.grid_stations(nc.filepath(),
+    ...                                         [-158, -157.5], [21, 21.2])
+    >>> temp = sta.extract(nc.variables['temp'], np.arange(10))
+    """
+
+    def __init__(self, grid, lon, lat, depth=None):
+        self.grid = seapy.model.asgrid(grid)
+        self.lon = np.atleast_1d(lon).astype(float)
+        self.lat = np.atleast_1d(lat).astype(float)
+        self.depth = None if depth is None else np.abs(np.broadcast_to(
+            np.atleast_1d(depth).astype(float), self.lon.shape))
+        self._j, self._i = self.grid._index("rho").ij(
+            self.lon, self.lat, np.ma.getdata(self.grid.angle))
+        self._stencils = {}
+
+    def _stencil(self, grid):
+        """
+        PRIVATE method: compute the horizontal weights, indices, and the
+        hyperslabs to read for the given staggered grid, and the vertical
+        weights if there are station depths
+        """
+        if grid in self._stencils:
+            return self._stencils[grid]
+        w, j, i = _bilinear(self.grid, self._j, self._i, grid)
+        mask = w.sum(axis=1) == 0
+        good = np.nonzero(~mask)[0]
+
+        # Read everything at once if the stations are clustered; otherwise,
+        # read the 2x2 cells around each stencil
+        slabs = []
+        if good.size:
+            jb = slice(j[good].min(), j[good].max() + 1)
+            ib = slice(i[good].min(), i[good].max() + 1)
+            if (jb.stop - jb.start) * (ib.stop - ib.start) <= 16 * good.size:
+                slabs.append((jb, ib, good))
+            else:
+                corner, grp = np.unique(np.vstack((j[good, 0], i[good, 0])),
+                                        axis=1, return_inverse=True)
+                for n in range(corner.shape[1]):
+                    slabs.append((slice(corner[0, n], corner[0, n] + 2),
+                                  slice(corner[1, n], corner[1, n] + 2),
+                                  good[grp.ravel() == n]))
+
+        # Vertical weights from the depths of the layers at each station
+        vert = None
+        if self.depth is not None:
+            depth = np.ma.getdata(getattr(self.grid, "depth_" + grid))
+            dcol = np.einsum("pc,kpc->pk", w, depth[:, j, i])
+            levels = np.arange(self.grid.n)
+            if depth[0, 0, 0] > depth[-1, 0, 0]:
+                levels = levels[::-1]
+            dcol = dcol[:, levels]
+            z = -self.depth[:, np.newaxis]
+            hi = np.clip(np.sum(dcol < z, axis=1), 1, self.grid.n - 1)
+            lo = hi - 1
+            pts = np.arange(self.lon.size)
+            dlo, dhi = dcol[pts, lo], dcol[pts, hi]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                fk = np.nan_to_num(np.clip((z[:, 0] - dlo) / (dhi - dlo),
+                                           0, 1))
+            h = np.einsum("pc,pc->p", w, np.ma.getdata(self.grid.h)[j, i])
+            vert = (levels[lo], levels[hi], fk,
+                    np.logical_or(mask, self.depth > h))
+        self._stencils[grid] = (w, j, i, mask, slabs, vert)
+        return self._stencils[grid]
+
+    def extract(self, var, records=None):
+        """
+        Extract the time-series of a variable at the stations
+
+        Parameters
+        ----------
+        var : netCDF4.Variable or ndarray,
+            ROMS 2-D or 3-D field with a leading record dimension
+            [time, (N,) eta, xi] on the rho, u, or v grid
+        records : array, optional
+            the records to extract. Default is all records.
+
+        Returns
+        -------
+        vals: np.ma.array
+            values at the stations [time, station] for 2-D fields and
+            fields at a depth, or [time, N, station] for 3-D fields
+        """
+        shp = var.shape[-2:]
+        grid = "rho"
+        if shp == self.grid.mask_u.shape:
+            grid = "u"
+        elif shp == self.grid.mask_v.shape:
+            grid = "v"
+        w, j, i, mask, slabs, vert = self._stencil(grid)
+        if records is None:
+            records = np.arange(var.shape[0])
+        records = np.atleast_1d(records)
+
+        vals = np.zeros((records.size,) + tuple(var.shape[1:-2]) +
+                        (self.lon.size,))
+        for jb, ib, pts in slabs:
+            data = np.ma.filled(var[records, ..., jb, ib], 0)
+            vals[..., pts] = np.sum(
+                data[..., j[pts] - jb.start, i[pts] - ib.start] * w[pts],
+                axis=-1)
+        if vert is not None and vals.ndim == 3:
+            lo, hi, fk, mask = vert
+            pts = np.arange(self.lon.size)
+            vals = vals[:, lo, pts] * (1 - fk) + vals[:, hi, pts] * fk
+        return np.ma.array(vals, mask=np.broadcast_to(mask, vals.shape))
+
+
+def gen_station_series(roms_file, sta_file, lon, lat, depth=None,
+                       fields=None, records=None, chunk=100, clobber=False):
+    """
+    Extract the time-series of fields at a list of stations from a ROMS
+    history (or average) file and store them into a station file using the
+    dimensions of the ROMS station output (ocean_time, station, s_rho). See
+    grid_stations for the interpolation.
+
+    Parameters
+    ----------
+    roms_file: string or list of strings,
+        The ROMS (history or average) file from which to extract. If it is a
+        list of strings, a netCDF4.MFDataset is opened instead.
+    sta_file: string,
+        The name of the file to store the station time-series
+    lon : array,
+        Longitudes of the stations
+    lat : array,
+        Latitudes of the stations
+    depth : float or array, optional
+        Depth (in meters) of each station. If not given, the 3-D fields are
+        extracted at every layer.
+    fields: list of str, optional
+        The fields to extract. Default is to use the ROMS prognostic
+        variables in the file.
+    records: ndarray, optional
+        List of records to extract. Default is all records.
+    chunk: int, optional
+        The number of records to extract at a time
+    clobber: bool, optional
+        If True, clobber any existing sta_file
+
+    Returns
+    -------
+    sta : grid_stations
+        The stations, which may be used to extract from other files
+
+    Examples
+    --------
+    >>> seapy.roms.analysis.gen_station_series("ocean_his.nc", "moorings.nc",
+    ...                                        [-158, -157.5], [21, 21.2],
+    ...                                        depth=[50, 100])
+    """
+    # Open the ROMS info
+    nc = seapy.netcdf(roms_file)
+    sta = grid_stations(roms_file, lon, lat, depth)
+    epoch, time_var = seapy.roms.get_reftime(nc)
+    if fields is None:
+        fields = seapy.roms.fields
+    fields = [f for f in fields if f in nc.variables and
+              nc.variables[f].dimensions[0] == time_var and
+              nc.variables[f].ndim in (3, 4)]
+    if records is None:
+        records = np.arange(len(nc.variables[time_var]))
+    else:
+        records = np.atleast_1d(records)
+
+    # Build the output file
+    dims = {"ocean_time": 0, "station": sta.lon.size}
+    vars = [{"name": "ocean_time", "type": "f8", "dims": "ocean_time",
+             "attr": {"long_name": "time since initialization",
+                      "units": "seconds since " + str(epoch)}},
+            {"name": "lon_rho", "type": "f8", "dims": "station",
+             "attr": {"long_name": "longitude of stations",
+                      "units": "degree_east"}},
+            {"name": "lat_rho", "type": "f8", "dims": "station",
+             "attr": {"long_name": "latitude of stations",
+                      "units": "degree_north"}}]
+    if depth is not None:
+        vars.append({"name": "depth", "type": "f8", "dims": "station",
+                     "attr": {"long_name": "depth of stations",
+                              "units": "meter"}})
+    for f in fields:
+        fdims = "ocean_time, station"
+        if nc.variables[f].ndim == 4 and depth is None:
+            fdims += ", s_rho"
+            dims["s_rho"] = sta.grid.n
+        attr = {a: nc.variables[f].getncattr(a) for a in ("long_name", "units")
+                if a in nc.variables[f].ncattrs()}
+        vars.append({"name": f, "type": "f4", "dims": fdims, "attr": attr})
+    ncout = seapy.roms.ncgen.ncgen(sta_file, dims=dims, vars=vars,
+                                   clobber=clobber,
+                                   title="stations from " + str(roms_file))
+    ncout.variables["lon_rho"][:] = sta.lon
+    ncout.variables["lat_rho"][:] = sta.lat
+    if depth is not None:
+        ncout.variables["depth"][:] = sta.depth
+    start = len(ncout.variables["ocean_time"])
+
+    # Extract each chunk of records
+    for n in track(range(0, records.size, chunk),
+                   description="extract stations"):
+        recs = records[n:n + chunk]
+        out = slice(start + n, start + n + recs.size)
+        ncout.variables["ocean_time"][out] = seapy.roms.date2num(
+            seapy.roms.num2date(nc, time_var, recs), ncout, "ocean_time")
+        for f in fields:
+            vals = sta.extract(nc.variables[f], recs)
+            if vals.ndim == 3:
+                vals = np.ma.swapaxes(vals, 1, 2)
+            ncout.variables[f][out, ...] = vals
+        ncout.sync()
+    ncout.close()
+    nc.close()
+    return sta
+
+
+class section:
+    """
+    Section through a ROMS grid for computing the transport of volume and
+    tracers. The polyline of longitude/latitude points is followed along the
+    edges of the grid cells (the psi-points), so that the section is made of
+    the u- and v-faces it crosses. The faces, their widths, and the sign of
+    the flux through each are computed once, and the transports of any
+    number of records are computed with vectorized sums over the faces.
+
+    The transport is positive to the left of the direction of the section
+    (e.g., northward for a section drawn from west to east on a grid with
+    xi pointing east).
+
+    Parameters
+    ----------
+    grid : seapy.model.grid or string or list,
+        Grid of the fields
+    lon : array,
+        Longitudes of the points defining the path of the section
+    lat : array,
+        Latitudes of the points defining the path of the section
+    name : string, optional
+        Name of the section
+
+    Attributes
+    ----------
+    lon, lat : array
+        location of each face of the section
+    width : array
+        width [m] of each face of the section
+
+    Examples
+    --------
+    >>> nc = seapy.netcdf('roms_his.nc')
+    >>> sec = seapy.roms.analysis.section(nc.filepath(),
+    ...                                   [-158, -157], [21.5, 21.5])
+    >>> trans = sec.transport(nc.variables['u'][:], nc.variables['v'][:],
+    ...                       nc.variables['zeta'][:],
+    ...                       {"temp": nc.variables['temp'][:]})
+    """
+
+    def __init__(self, grid, lon, lat, name=None):
+        self.grid = seapy.model.asgrid(grid)
+        self.name = name
+        j, i = self.grid._index("rho").ij(
+            np.atleast_1d(lon).astype(float), np.atleast_1d(lat).astype(float),
+            np.ma.getdata(self.grid.angle))
+        if np.any(j < 0) or np.any(i < 0):
+            raise ValueError("section points must be within the grid")
+        ln, lm = self.grid.mask_rho.shape
+        path = self.__staircase(
+            np.clip(np.round(j - 0.5), 0, ln - 2).astype(int),
+            np.clip(np.round(i - 0.5), 0, lm - 2).astype(int))
+
+        # Find the face crossed by each step along the psi-points and the
+        # sign of the flux to the left of the step
+        dj, di = np.diff(path, axis=0).T
+        pj, pi = path[:-1].T
+        isu = dj != 0
+        self._isu = isu
+        self._j = np.where(isu, pj + (dj > 0), pj)
+        self._i = np.where(isu, pi, pi + (di > 0))
+        self._sign = np.where(isu, -dj, di).astype(float)
+
+        # The two rho-cells on either side of each face
+        self._cj = np.stack((self._j, self._j + ~isu))
+        self._ci = np.stack((self._i, self._i + isu))
+        self.lon = self._faces(self.grid.lon_u, self.grid.lon_v)
+        self.lat = self._faces(self.grid.lat_u, self.grid.lat_v)
+        dn, dm = np.ma.getdata(self.grid.dn), np.ma.getdata(self.grid.dm)
+        self.width = np.where(isu, dn[self._cj, self._ci].mean(axis=0),
+                              dm[self._cj, self._ci].mean(axis=0))
+        self._sign *= self._faces(self.grid.mask_u, self.grid.mask_v)
+
+    @staticmethod
+    def __staircase(pj, pi):
+        """
+        PRIVATE method: connect the psi-points of the vertices with unit
+        steps that stay closest to the straight line between each pair
+        """
+        path = [(pj[0], pi[0])]
+        for j1, i1 in zip(pj[1:], pi[1:]):
+            j0, i0 = path[-1]
+            cj, ci = j0, i0
+            while (cj, ci) != (j1, i1):
+                steps = []
+                if cj != j1:
+                    steps.append((cj + np.sign(j1 - j0), ci))
+                if ci != i1:
+                    steps.append((cj, ci + np.sign(i1 - i0)))
+                cj, ci = min(steps, key=lambda p: abs(
+                    (p[0] - j0) * (i1 - i0) - (p[1] - i0) * (j1 - j0)))
+                path.append((cj, ci))
+        return np.array(path, dtype=int).reshape(-1, 2)
+
+    def _faces(self, u, v):
+        """
+        PRIVATE method: gather the values of the u- and v-grid fields at
+        each face [..., face]
+        """
+        isu = self._isu
+        vals = np.zeros(np.shape(u)[:-2] + isu.shape)
+        vals[..., isu] = np.ma.filled(u[..., self._j[isu], self._i[isu]], 0)
+        vals[..., ~isu] = np.ma.filled(v[..., self._j[~isu], self._i[~isu]],
+                                       0)
+        return vals
+
+    def area(self, zeta=None):
+        """
+        Compute the area of each layer of each face of the section
+
+        Parameters
+        ----------
+        zeta : ndarray, optional
+            sea surface height [(time,) eta, xi]. If not given, the depths
+            of the grid at rest are used.
+
+        Returns
+        -------
+        area : ndarray
+            area [m**2] of the faces [(time,) N, face]
+        """
+        if zeta is None:
+            hz = np.ma.getdata(self.grid.thick_rho)[:, self._cj, self._ci]
+        else:
+            s_w, cs_w = seapy.roms.stretching(
+                self.grid.vstretching, self.grid.theta_s, self.grid.theta_b,
+                self.grid.hc, self.grid.n, w_grid=True)
+            hz = seapy.roms.thickness(
+                self.grid.vtransform, np.ma.getdata(self.grid.h)[
+                    self._cj, self._ci], self.grid.hc, s_w, cs_w,
+                np.ma.filled(zeta[..., self._cj, self._ci], 0))
+        return hz.mean(axis=-2) * self.width
+
+    def transport(self, u, v, zeta=None, tracers=None):
+        """
+        Compute the transport of volume and tracers through the section
+
+        Parameters
+        ----------
+        u : ndarray,
+            u-velocity [(time,) N, eta, xi]
+        v : ndarray,
+            v-velocity [(time,) N, eta, xi]
+        zeta : ndarray, optional
+            sea surface height [(time,) eta, xi]. If not given, the depths
+            of the grid at rest are used.
+        tracers : dict, optional
+            rho-grid tracer fields [(time,) N, eta, xi] by name to compute
+            the transports of. The tracer of each face is the average of the
+            cells on either side.
+
+        Returns
+        -------
+        transport : dict
+            "volume" transport [m**3 s**-1] and the transport of each tracer
+            [tracer * m**3 s**-1] through the section for each record
+        """
+        flux = self._faces(u, v) * self.area(zeta) * self._sign
+        trans = {"volume": flux.sum(axis=(-2, -1))}
+        for t in tracers or {}:
+            val = np.ma.filled(tracers[t][..., self._cj, self._ci], 0)
+            trans[t] = np.sum(flux * val.mean(axis=-2), axis=(-2, -1))
+        return trans
+
+
+def gen_transport(roms_file, trans_file, sections, tracers=None, zeta=True,
+                  records=None, chunk=10, clobber=False):
+    """
+    Compute the transports of volume and tracers through many sections for
+    the records of a ROMS history (or average) file and store them into a
+    new file. Each record is read once for all of the sections.
+
+    Parameters
+    ----------
+    roms_file: string or list of strings,
+        The ROMS (history or average) file from which to compute the
+        transports. If it is a list of strings, a netCDF4.MFDataset is
+        opened instead.
+    trans_file: string,
+        The name of the file to store the transports
+    sections: list of section,
+        The sections to compute the transports through
+    tracers: list of str, optional
+        The tracers (e.g., temp, salt) to compute the transports of
+    zeta: bool, optional
+        If True (default) and zeta is in the file, use the sea surface height
+        of each record for the areas of the faces
+    records: ndarray, optional
+        List of records to use. Default is all records.
+    chunk: int, optional
+        The number of records to read at a time
+    clobber: bool, optional
+        If True, clobber any existing trans_file
+
+    Returns
+    -------
+        None
+
+    Examples
+    --------
+    >>> grid = seapy.model.asgrid("ocean_grd.nc")
+    >>> secs = [seapy.roms.analysis.section(grid, [-158, -157], [21.5, 21.5],
+    ...                                     name="north")]
+    >>> seapy.roms.analysis.gen_transport("ocean_his.nc", "ocean_trans.nc",
+    ...                                   secs, tracers=["temp", "salt"])
+    """
+    nc = seapy.netcdf(roms_file)
+    epoch, time_var = seapy.roms.get_reftime(nc)
+    tracers = [t for t in (tracers or []) if t in nc.variables]
+    zeta = zeta and "zeta" in nc.variables
+    if records is None:
+        records = np.arange(len(nc.variables[time_var]))
+    else:
+        records = np.atleast_1d(records)
+
+    # Build the output file
+    names = [s.name or "section {:d}".format(n)
+             for n, s in enumerate(sections)]
+    vars = [{"name": "ocean_time", "type": "f8", "dims": "ocean_time",
+             "attr": {"long_name": "time since initialization",
+                      "units": "seconds since " + str(epoch)}},
+            {"name": "transport", "type": "f8",
+             "dims": "ocean_time, section",
+             "attr": {"long_name": "volume transport",
+                      "units": "meter3 second-1"}}]
+    for t in tracers:
+        units = nc.variables[t].units \
+            if "units" in nc.variables[t].ncattrs() else ""
+        vars.append({"name": t + "_transport", "type": "f8",
+                     "dims": "ocean_time, section",
+                     "attr": {"long_name": t + " transport",
+                              "units": (units + " meter3 second-1").strip()}})
+    ncout = seapy.roms.ncgen.ncgen(trans_file,
+                                   dims={"ocean_time": 0,
+                                         "section": len(sections)},
+                                   vars=vars,
+                                   attr={"sections": ", ".join(names)},
+                                   clobber=clobber,
+                                   title="transports from " + str(roms_file))
+    start = len(ncout.variables["ocean_time"])
+
+    # Compute the transports of each chunk of records
+    for n in track(range(0, records.size, chunk),
+                   description="compute transports"):
+        recs = records[n:n + chunk]
+        out = slice(start + n, start + n + recs.size)
+        ncout.variables["ocean_time"][out] = seapy.roms.date2num(
+            seapy.roms.num2date(nc, time_var, recs), ncout, "ocean_time")
+        u = nc.variables["u"][recs, ...]
+        v = nc.variables["v"][recs, ...]
+        z = nc.variables["zeta"][recs, ...] if zeta else None
+        trac = {t: nc.variables[t][recs, ...] for t in tracers}
+        for s, sec in enumerate(sections):
+            trans = sec.transport(u, v, z, trac)
+            ncout.variables["transport"][out, s] = trans["volume"]
+            for t in tracers:
+                ncout.variables[t + "_transport"][out, s] = trans[t]
+        ncout.sync()
+    ncout.close()
+    nc.close()
+
+
+class region_average:
+    """
+    Area-weighted averages of rho-grid fields over many regions. The
+    membership of the grid cells in each region (defined by a polygon or a
+    mask) and their areas are combined once into a sparse matrix of weights
+    [region, cell], so that the averages of all regions for every record and
+    level are computed with a single sparse product. Land is excluded.
+
+    Parameters
+    ----------
+    grid : seapy.model.grid or string or list,
+        Grid of the fields
+    regions : dict,
+        The regions by name. Each is either a list of (lon, lat) vertices of
+        a polygon or a boolean array [eta, xi] that is True within the
+        region.
+
+    Attributes
+    ----------
+    names : list
+        names of the regions
+    area : ndarray
+        area [m**2] of the wet cells of each region
+
+    Examples
+    --------
+    >>> nc = seapy.netcdf('roms_his.nc')
+    >>> reg = seapy.roms.analysis.region_average(nc.filepath(),
+    ...           {"north": [(-158, 21), (-157, 21), (-157, 22), (-158, 22)],
+    ...            "deep": grid.h > 1000})
+    >>> sst = reg.average(nc.variables['temp'][:, -1, ...])
+    """
+
+    def __init__(self, grid, regions):
+        self.grid = seapy.model.asgrid(grid)
+        self.names = list(regions)
+        lon = np.ma.getdata(self.grid.lon_rho).ravel()
+        lat = np.ma.getdata(self.grid.lat_rho).ravel()
+        area = (np.ma.getdata(self.grid.dm) * np.ma.getdata(self.grid.dn) *
+                np.ma.getdata(self.grid.mask_rho)).ravel()
+
+        rows, cols = [], []
+        for n, r in enumerate(regions.values()):
+            region = np.asanyarray(r)
+            if region.shape == self.grid.mask_rho.shape:
+                inside = np.ma.filled(region, False).astype(bool).ravel()
+            else:
+                inside = matplotlib.path.Path(region).contains_points(
+                    np.vstack((lon, lat)).T)
+            cells = np.nonzero(np.logical_and(inside, area > 0))[0]
+            rows.append(np.full(cells.size, n))
+            cols.append(cells)
+        rows = np.concatenate(rows + [[]]).astype(int)
+        cols = np.concatenate(cols + [[]]).astype(int)
+        self._matrix = scipy.sparse.csr_matrix(
+            (area[cols], (rows, cols)), shape=(len(self.names), area.size))
+        self.area = np.asarray(self._matrix.sum(axis=1)).ravel()
+
+    def average(self, field):
+        """
+        Compute the average of the field over each region
+
+        Parameters
+        ----------
+        field : ndarray,
+            rho-grid field [..., eta, xi]. If it has leading dimensions
+            (e.g., time and depth), each is averaged.
+
+        Returns
+        -------
+        avg : np.ma.array
+            average of the field in each region [..., region], masked where
+            a region has no valid values
+        """
+        field = np.ma.asanyarray(field)
+        lead = field.shape[:-2]
+        data = np.ma.getdata(field).reshape(-1, self._matrix.shape[1])
+        if field.mask is np.ma.nomask:
+            total = self._matrix.dot(data.T)
+            weight = self.area[:, np.newaxis]
+        else:
+            # Account for the masked values of each record with a single
+            # product of the values and their weights
+            valid = ~np.ma.getmaskarray(field).reshape(data.shape)
+            both = self._matrix.dot(
+                np.vstack((np.where(valid, data, 0), valid)).T)
+            total, weight = both[:, :data.shape[0]], both[:, data.shape[0]:]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            avg = np.ma.masked_invalid(total / weight)
+        return avg.T.reshape(lead + (len(self.names),))
+
+
+def gen_region_average(roms_file, avg_file, regions, fields=None,
+                       records=None, chunk=10, clobber=False):
+    """
+    Compute the area-weighted averages of rho-grid fields over many regions
+    (see region_average) for the records of a ROMS history (or average) file
+    and store them into a new file. 3-D fields are averaged on each level.
+
+    Parameters
+    ----------
+    roms_file: string or list of strings,
+        The ROMS (history or average) file from which to compute the
+        averages. If it is a list of strings, a netCDF4.MFDataset is opened
+        instead.
+    avg_file: string,
+        The name of the file to store the averages
+    regions : dict or region_average,
+        The regions by name (see region_average) or a region_average
+    fields: list of str, optional
+        The rho-grid fields to average. Default is to use the ROMS
+        prognostic variables (zeta, temp, salt) in the file.
+    records: ndarray, optional
+        List of records to use. Default is all records.
+    chunk: int, optional
+        The number of records to average at a time
+    clobber: bool, optional
+        If True, clobber any existing avg_file
+
+    Returns
+    -------
+    reg : region_average
+        The regions, which may be used to average other files
+
+    Examples
+    --------
+    >>> seapy.roms.analysis.gen_region_average(
+    ...     "ocean_his.nc", "ocean_regions.nc",
+    ...     {"north": [(-158, 21), (-157, 21), (-157, 22), (-158, 22)]},
+    ...     fields=["temp"])
+    """
+    nc = seapy.netcdf(roms_file)
+    if not isinstance(regions, region_average):
+        regions = region_average(roms_file, regions)
+    epoch, time_var = seapy.roms.get_reftime(nc)
+    if fields is None:
+        fields = [f for f in seapy.roms.fields
+                  if seapy.roms.fields[f]["grid"] == "rho"]
+    fields = [f for f in fields if f in nc.variables and
+              nc.variables[f].dimensions[0] == time_var and
+              nc.variables[f].shape[-2:] == regions.grid.mask_rho.shape]
+    if records is None:
+        records = np.arange(len(nc.variables[time_var]))
+    else:
+        records = np.atleast_1d(records)
+
+    # Build the output file
+    dims = {"ocean_time": 0, "region": len(regions.names)}
+    vars = [{"name": "ocean_time", "type": "f8", "dims": "ocean_time",
+             "attr": {"long_name": "time since initialization",
+                      "units": "seconds since " + str(epoch)}},
+            {"name": "area", "type": "f8", "dims": "region",
+             "attr": {"long_name": "area of region", "units": "meter2"}}]
+    for f in fields:
+        fdims = "ocean_time, region"
+        if nc.variables[f].ndim == 4:
+            dims["s_rho"] = nc.variables[f].shape[1]
+            fdims = "ocean_time, s_rho, region"
+        attr = {a: nc.variables[f].getncattr(a) for a in ("long_name", "units")
+                if a in nc.variables[f].ncattrs()}
+        vars.append({"name": f, "type": "f4", "dims": fdims, "attr": attr})
+    ncout = seapy.roms.ncgen.ncgen(avg_file, dims=dims, vars=vars,
+                                   attr={"regions": ", ".join(regions.names)},
+                                   clobber=clobber,
+                                   title="region averages from " +
+                                   str(roms_file))
+    ncout.variables["area"][:] = regions.area
+    start = len(ncout.variables["ocean_time"])
+
+    # Average each chunk of records
+    for n in track(range(0, records.size, chunk),
+                   description="compute region averages"):
+        recs = records[n:n + chunk]
+        out = slice(start + n, start + n + recs.size)
+        ncout.variables["ocean_time"][out] = seapy.roms.date2num(
+            seapy.roms.num2date(nc, time_var, recs), ncout, "ocean_time")
+        for f in fields:
+            ncout.variables[f][out, ...] = regions.average(
+                nc.variables[f][recs, ...])
+        ncout.sync()
+    ncout.close()
+    nc.close()
+    return regions
+
+
+class running_stats:
+    """
+    Streaming accumulator of the mean and variance of a field. Blocks of
+    samples are added with a numerically stable one-pass update (Welford's
+    method, generalized by Chan et al. to combine blocks), so each sample
+    need only be read once. Accumulators that were computed separately
+    (e.g., from different files by different workers) may be merged.
+    Masked values are not counted.
+
+    Examples
+    --------
+    >>> stats = seapy.roms.analysis.running_stats()
+    >>> for n in range(0, 100, 10):
+    ...     stats.update(nc.variables['temp'][n:n + 10, ...])
+    >>> std = stats.std
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, data):
+        """
+        Add a block of samples to the statistics
+
+        Parameters
+        ----------
+        data : ndarray or masked array,
+            samples of the field to add, with the samples along the first
+            dimension
+
+        Returns
+        -------
+        self : running_stats
+        """
+        data = np.ma.asanyarray(data)
+        mask = np.ma.getmaskarray(data)
+        vals = np.where(mask, 0, np.ma.getdata(data)).astype(np.float64)
+        count = np.sum(~mask, axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.where(count > 0, vals.sum(axis=0) / count, 0)
+        m2 = np.sum(np.where(mask, 0, (vals - mean)**2), axis=0)
+        return self._combine(count, mean, m2)
+
+    def merge(self, other):
+        """
+        Merge the statistics accumulated by another running_stats
+
+        Parameters
+        ----------
+        other : running_stats,
+            statistics to merge into these
+
+        Returns
+        -------
+        self : running_stats
+        """
+        if other.mean is not None:
+            self._combine(other.count, other.mean, other.m2)
+        return self
+
+    def _combine(self, count, mean, m2):
+        """
+        PRIVATE method: combine the count, mean, and sum of the squared
+        differences of a set of samples into the statistics
+        """
+        if self.mean is None:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return self
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(divide="ignore", invalid="ignore"):
+            frac = np.where(total > 0, count / total, 0)
+        self.mean = self.mean + delta * frac
+        self.m2 = self.m2 + m2 + delta**2 * self.count * frac
+        self.count = total
+        return self
+
+    @property
+    def variance(self):
+        """
+        The (population) variance of the samples
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.ma.masked_where(self.count == 0, self.m2 / self.count)
+
+    @property
+    def std(self):
+        """
+        The (population) standard deviation of the samples
+        """
+        return np.ma.sqrt(self.variance)
+
+
+def __file_stats(roms_file, fields, records, chunk):
+    """
+    Internal function to accumulate the statistics of the fields over the
+    records of a file
+    """
+    nc = seapy.netcdf(roms_file)
+    stats = {v: running_stats() for v in fields}
+    for n in range(0, len(records), chunk):
+        recs = records[n:n + chunk]
+        for v in fields:
+            stats[v].update(nc.variables[v][recs, ...])
+    nc.close()
+    return stats
+
+
+def gen_std_i(roms_file, std_file, std_window=5, pad=1, skip=30, fields=None,
+              chunk=None):
     """
     Create a std file for the given ocean fields. This std file can be used
     for initial conditions constraint in 4D-Var. This requires a long-term
     model spinup file from which to compute the standard deviation.
 
+    The file is read once in chunks of records, and each record is added
+    to the running statistics of every window that includes it.
+
     Parameters
     ----------
     roms_file: string or list of strings,
@@ -419,6 +1576,8 @@ def gen_std_i(roms_file, std_file, std_window=5, pad=1, skip=30, fields=None):
     fields: list of str,
         The fields to compute std for. Default is to use the ROMS prognostic
         variables.
+    chunk: int, optional
+        The number of records to read at a time. Default is std_window.
 
     Returns
     -------
@@ -427,6 +1586,7 @@ def gen_std_i(roms_file, std_file, std_window=5, pad=1, skip=30, fields=None):
     # Create the fields to process
     if fields is None:
         fields = set(seapy.roms.fields)
+    chunk = std_window if chunk is None else chunk
 
     # Open the ROMS info
     grid = seapy.model.asgrid(roms_file)
@@ -449,27 +1609,48 @@ def gen_std_i(roms_file, std_file, std_window=5, pad=1, skip=30, fields=None):
         ncout.createVariable(f, np.float32,
                              ('ocean_time', "s_rho", "eta_rho", "xi_rho"))
 
-    # Loop over the time with the variance window:
+    # Loop over the records once, accumulating the statistics of each
+    # variance window that the records are in
     time_list = np.arange(skip + pad, len(time) - std_window - pad, std_window)
-    for n, t in track(enumerate(time_list), total=len(time_list),
-                      description="evaluate time window"):
-        idx = np.arange(t - pad, t + std_window + pad)
-        ncout.variables[time_var][n] = np.mean(time[idx])
-        for v in fields:
-            dat = nc.variables[v][idx, :].std(axis=0)
-            dat[dat > 10] = 0.0
-            ncout.variables[v][n, :] = dat
-        ncout.sync()
+    starts = time_list - pad
+    ends = time_list + std_window + pad
+    stats = {}
+    for r in track(range(starts.min(), ends.max(), chunk) if time_list.size
+                   else [], description="evaluate time window"):
+        recs = np.arange(r, min(r + chunk, ends.max()))
+        data = {v: nc.variables[v][recs, :] for v in fields}
+        for n in np.nonzero((starts < recs[-1] + 1) & (ends > r))[0]:
+            l = np.logical_and(recs >= starts[n], recs < ends[n])
+            if n not in stats:
+                stats[n] = {v: running_stats() for v in fields}
+            for v in fields:
+                stats[n][v].update(data[v][l, ...])
+
+            # If the window is complete, save it
+            if ends[n] <= recs[-1] + 1:
+                ncout.variables[time_var][n] = \
+                    np.mean(time[starts[n]:ends[n]])
+                for v in fields:
+                    dat = stats[n][v].std
+                    dat[dat > 10] = 0.0
+                    ncout.variables[v][n, :] = dat
+                del stats[n]
+                ncout.sync()
     ncout.close()
     nc.close()
 
 
-def gen_std_f(roms_file, std_file, records=None, fields=None):
+def gen_std_f(roms_file, std_file, records=None, fields=None, chunk=10,
+              threads=1):
     """
     Create a std file for the given atmospheric forcing fields. This std
     file can be used for the forcing constraint in 4D-Var. This requires a
     long-term model spinup file from which to compute the standard deviation.
 
+    Each record is read once to accumulate the running statistics. If a list
+    of files is given, the statistics of each file may be accumulated in
+    parallel and merged.
+
     Parameters
     ----------
     roms_file: string or list of strings,
@@ -483,6 +1664,10 @@ def gen_std_f(roms_file, std_file, records=None, fields=None):
     fields: list of str,
         The fields to compute std for. Default is to use the ROMS atmospheric
         variables (sustr, svstr, shflux, ssflux).
+    chunk: int, optional
+        The number of records to read at a time
+    threads: int, optional
+        The number of files to process in parallel if roms_file is a list
 
     Returns
     -------
@@ -512,7 +1697,7 @@ def gen_std_f(roms_file, std_file, records=None, fields=None):
         records = np.arange(len(time))
     else:
         records = np.atleast_1d(records)
-        records = records[records <= len(time)]
+        records = records[records < len(time)]
 
     # If there are any fields that are not part of the standard, add them
     # to the output file
@@ -520,11 +1705,455 @@ def gen_std_f(roms_file, std_file, records=None, fields=None):
         ncout.createVariable(f, np.float32,
                              ('ocean_time', "eta_rho", "xi_rho"))
 
-    # Loop over the time with the variance window:
+    # Accumulate the statistics of the records, by file if we have a list
+    if isinstance(roms_file, (list, tuple)) and threads > 1:
+        nc.close()
+        offset = 0
+        jobs = []
+        for f in roms_file:
+            nc = seapy.netcdf(f)
+            nrec = len(nc.variables[time_var])
+            nc.close()
+            recs = records[(records >= offset) & (records < offset + nrec)]
+            if recs.size:
+                jobs.append((f, recs - offset))
+            offset += nrec
+        stats = {v: running_stats() for v in fields}
+        for part in Parallel(n_jobs=threads)(
+                delayed(__file_stats)(f, fields, recs, chunk)
+                for f, recs in jobs):
+            for v in fields:
+                stats[v].merge(part[v])
+    else:
+        stats = __file_stats(roms_file, fields, records, chunk)
+        nc.close()
+
+    # Save the std of each field
     ncout.variables[time_var][:] = np.mean(time[records])
     for v in fields:
-        dat = nc.variables[v][records, :].std(axis=0)
-        ncout.variables[v][0, :] = dat
+        ncout.variables[v][0, :] = stats[v].std
+        ncout.sync()
+    ncout.close()
+
+
+__climatology_bins = {
+    "month": (12, "month of year"),
+    "dayofyear": (366, "day of year"),
+    "season": (4, "season of year: DJF, MAM, JJA, SON")
+}
+
+
+def __climatology_keys(times, by):
+    """
+    Internal function to compute the climatology bin of each time
+    """
+    if by == "month":
+        return np.array([t.month for t in times]) - 1
+    elif by == "dayofyear":
+        return np.array([t.timetuple().tm_yday for t in times]) - 1
+    else:
+        return (np.array([t.month for t in times]) % 12) // 3
+
+
+def gen_climatology(roms_file, clim_file, by="month", fields=None,
+                    anomaly_file=None, records=None, chunk=10,
+                    max_memory=2e9, clobber=False):
+    """
+    Compute the climatology of fields from a ROMS history (or average)
+    file by binning each record by its calendar month, day of year, or
+    season, and store the climatology (and optionally the anomalies from the
+    climatology) into new files. The records are read in chunks and added to
+    running sums (and counts of unmasked values) of each bin, so the records
+    are only read once to compute the climatology. If the sums of all fields
+    would exceed max_memory, the fields are processed in groups that fit.
+    The anomalies require a second pass through the records.
+
+    Parameters
+    ----------
+    roms_file: string or list of strings,
+        The ROMS (history or average) file from which to compute the
+        climatology. If it is a list of strings, a netCDF4.MFDataset is
+        opened instead.
+    clim_file: string,
+        The name of the file to store the climatology
+    by: string, optional
+        The calendar bins of the climatology: "month" (default),
+        "dayofyear", or "season" (DJF, MAM, JJA, SON)
+    fields: list of str, optional
+        The fields to compute the climatology for. Default is to use the
+        ROMS prognostic variables in the file.
+    anomaly_file: string, optional
+        If given, the name of the file to store the anomaly of each record
+        from the climatology
+    records: ndarray, optional
+        List of records to use. Default is all records.
+    chunk: int, optional
+        The number of records to read at a time
+    max_memory: float, optional
+        The number of bytes the running sums of the fields may use
+    clobber: bool, optional
+        If True, clobber any existing output files
+
+    Returns
+    -------
+        None
+
+    Examples
+    --------
+    >>> seapy.roms.analysis.gen_climatology("ocean_avg.nc", "ocean_clim.nc",
+    ...                                     by="month",
+    ...                                     anomaly_file="ocean_anom.nc")
+    """
+    if by not in __climatology_bins:
+        raise ValueError("by must be one of: " +
+                         ", ".join(__climatology_bins))
+    nbins, long_name = __climatology_bins[by]
+
+    # Open the ROMS info
+    nc = seapy.netcdf(roms_file)
+    epoch, time_var = seapy.roms.get_reftime(nc)
+    if fields is None:
+        fields = seapy.roms.fields
+    fields = [f for f in fields if f in nc.variables and
+              nc.variables[f].dimensions[0] == time_var]
+    if records is None:
+        records = np.arange(len(nc.variables[time_var]))
+    else:
+        records = np.atleast_1d(records)
+    keys = __climatology_keys(seapy.roms.num2date(nc, time_var, records), by)
+
+    # Build the output files with the dimensions of the fields
+    dims = {}
+    for f in fields:
+        dims.update({d: len(nc.dimensions[d])
+                     for d in nc.variables[f].dimensions[1:]})
+    vars = []
+    for f in fields:
+        attr = {a: nc.variables[f].getncattr(a) for a in ("long_name", "units")
+                if a in nc.variables[f].ncattrs()}
+        vars.append({"name": f, "type": "f4",
+                     "dims": ", ".join((time_var,) +
+                                       nc.variables[f].dimensions[1:]),
+                     "attr": attr})
+    ncout = seapy.roms.ncgen.ncgen(
+        clim_file, dims={**dims, "clim_time": nbins},
+        vars=[{"name": "clim_time", "type": "f8", "dims": "clim_time",
+               "attr": {"long_name": long_name}},
+              {"name": "records", "type": "i4", "dims": "clim_time",
+               "attr": {"long_name": "number of records in climatology"}}] +
+        [{**v, "dims": v["dims"].replace(time_var, "clim_time", 1)}
+         for v in vars],
+        clobber=clobber, title=by + " climatology from " + str(roms_file))
+    ncout.variables["clim_time"][:] = np.arange(nbins) + (by != "season")
+    ncout.variables["records"][:] = np.bincount(keys, minlength=nbins)
+
+    # Group the fields so the sums of each group fit into memory
+    groups = [[]]
+    size = 0
+    for f in fields:
+        fsize = nbins * 12 * np.prod(nc.variables[f].shape[1:])
+        if groups[-1] and size + fsize > max_memory:
+            groups.append([])
+            size = 0
+        groups[-1].append(f)
+        size += fsize
+
+    # Accumulate the sums of each bin
+    for group in groups:
+        sums = {f: np.zeros((nbins,) + nc.variables[f].shape[1:])
+                for f in group}
+        counts = {f: np.zeros((nbins,) + nc.variables[f].shape[1:],
+                              dtype=np.int32) for f in group}
+        for n in track(range(0, records.size, chunk),
+                       description="compute climatology"):
+            recs = records[n:n + chunk]
+            bins = keys[n:n + chunk]
+            for f in group:
+                data = nc.variables[f][recs, ...]
+                valid = ~np.ma.getmaskarray(data)
+                data = np.ma.filled(data, 0)
+                for b in np.unique(bins):
+                    l = bins == b
+                    sums[f][b] += np.sum(data[l], axis=0)
+                    counts[f][b] += np.sum(valid[l], axis=0)
+        for f in group:
+            ncout.variables[f][:] = np.ma.masked_where(
+                counts[f] == 0, sums[f] / np.maximum(counts[f], 1))
+        ncout.sync()
+        del sums, counts
+
+    # Compute the anomalies from the climatology
+    if anomaly_file is not None:
+        ncanom = seapy.roms.ncgen.ncgen(
+            anomaly_file, dims={**dims, time_var: 0},
+            vars=[{"name": time_var, "type": "f8", "dims": time_var,
+                   "attr": {"long_name": "time since initialization",
+                            "units": "seconds since " + str(epoch)}}] + vars,
+            clobber=clobber, title="anomaly from " + by +
+            " climatology of " + str(roms_file))
+        start = len(ncanom.variables[time_var])
+        for n in track(range(0, records.size, chunk),
+                       description="compute anomalies"):
+            recs = records[n:n + chunk]
+            out = slice(start + n, start + n + recs.size)
+            ncanom.variables[time_var][out] = seapy.roms.date2num(
+                seapy.roms.num2date(nc, time_var, recs), ncanom, time_var)
+            bins, idx = np.unique(keys[n:n + chunk], return_inverse=True)
+            for f in fields:
+                ncanom.variables[f][out, ...] = nc.variables[f][recs, ...] - \
+                    ncout.variables[f][bins, ...][idx]
+            ncanom.sync()
+        ncanom.close()
+    ncout.close()
+    nc.close()
+
+
+derived_fields = {
+    "vorticity": {"long_name": "relative vorticity",
+                  "units": "second-1"},
+    "divergence": {"long_name": "horizontal divergence",
+                   "units": "second-1"},
+    "ke": {"long_name": "kinetic energy per unit mass",
+           "units": "meter2 second-2"},
+    "okubo_weiss": {"long_name": "Okubo-Weiss parameter",
+                    "units": "second-2"}
+}
+
+
+def __average4(val):
+    """
+    Internal function to average each set of four neighboring points (e.g.,
+    from the psi-grid onto the interior rho-grid or from rho onto psi)
+    """
+    return 0.25 * (val[..., :-1, :-1] + val[..., :-1, 1:] +
+                   val[..., 1:, :-1] + val[..., 1:, 1:])
+
+
+def derived(grid, u, v, fields=None):
+    """
+    Compute fields derived from the velocity on the interior of the rho-grid.
+    The velocity gradients (and their metrics) are computed once and shared
+    by all of the requested fields:
+
+    - vorticity: dv/dx - du/dy
+    - divergence: du/dx + dv/dy
+    - ke: (u**2 + v**2) / 2
+    - okubo_weiss: normal strain**2 + shear strain**2 - vorticity**2
+
+    The gradients involving both u and v (vorticity and shear strain) are
+    computed on the psi-grid and averaged onto the rho-grid. The edges of
+    the grid and land are masked.
+
+    Parameters
+    ----------
+    grid : seapy.model.grid or string or list,
+        Grid of the velocity
+    u : ndarray,
+        u-velocity [..., eta, xi]
+    v : ndarray,
+        v-velocity [..., eta, xi]
+    fields : list of str, optional
+        Fields to compute (see derived_fields). Default is all.
+
+    Returns
+    -------
+    derived : dict
+        masked array [..., eta_rho, xi_rho] of each field
+
+    Examples
+    --------
+    >>> nc = seapy.netcdf('roms_his.nc')
+    >>> d = seapy.roms.analysis.derived(nc.filepath(),
+    ...                                 nc.variables['u'][0, -1, ...],
+    ...                                 nc.variables['v'][0, -1, ...],
+    ...                                 ['vorticity', 'okubo_weiss'])
+    """
+    grid = seapy.model.asgrid(grid)
+    if fields is None:
+        fields = derived_fields
+    u = np.ma.filled(u, 0)
+    v = np.ma.filled(v, 0)
+    pm = np.ma.getdata(grid.pm)
+    pn = np.ma.getdata(grid.pn)
+
+    # The shared intermediates are computed the first time they are needed
+    terms = {}
+    recipes = {
+        "dudx": lambda: np.diff(u[..., 1:-1, :], axis=-1) * pm[1:-1, 1:-1],
+        "dvdy": lambda: np.diff(v[..., 1:-1], axis=-2) * pn[1:-1, 1:-1],
+        "dvdx": lambda: np.diff(v, axis=-1) * __average4(pm),
+        "dudy": lambda: np.diff(u, axis=-2) * __average4(pn),
+        "zeta": lambda: term("dvdx") - term("dudy"),
+        "vorticity": lambda: __average4(term("zeta")),
+        "divergence": lambda: term("dudx") + term("dvdy"),
+        "ke": lambda: 0.25 * (u[..., 1:-1, :-1]**2 + u[..., 1:-1, 1:]**2 +
+                              v[..., :-1, 1:-1]**2 + v[..., 1:, 1:-1]**2),
+        "okubo_weiss": lambda: (term("dudx") - term("dvdy"))**2 +
+        __average4((term("dvdx") + term("dudy"))**2 - term("zeta")**2)
+    }
+
+    def term(name):
+        if name not in terms:
+            terms[name] = recipes[name]()
+        return terms[name]
+
+    mask = np.ones(grid.mask_rho.shape, dtype=bool)
+    mask[1:-1, 1:-1] = np.ma.getdata(grid.mask_rho)[1:-1, 1:-1] == 0
+    out = {}
+    for f in fields:
+        val = np.zeros(u.shape[:-1] + (u.shape[-1] + 1,))
+        val[..., 1:-1, 1:-1] = term(f)
+        out[f] = np.ma.array(val, mask=np.broadcast_to(mask, val.shape))
+    return out
+
+
+def gen_derived(roms_file, derived_file, fields=None, velocity=("u", "v"),
+                records=None, chunk=5, clobber=False):
+    """
+    Compute fields derived from the velocity (see derived) for the records
+    of a ROMS history (or average) file and store them into a new file. The
+    velocity of each chunk of records is read once and all of the fields
+    are computed from it.
+
+    Parameters
+    ----------
+    roms_file: string or list of strings,
+        The ROMS (history or average) file from which to compute the fields.
+        If it is a list of strings, a netCDF4.MFDataset is opened instead.
+    derived_file: string,
+        The name of the file to store the derived fields
+    fields : list of str, optional
+        Fields to compute (see derived_fields). Default is all.
+    velocity : tuple of str, optional
+        The names of the u and v velocity (e.g., ("ubar", "vbar"))
+    records: ndarray, optional
+        List of records to use. Default is all records.
+    chunk: int, optional
+        The number of records to compute at a time
+    clobber: bool, optional
+        If True, clobber any existing derived_file
+
+    Returns
+    -------
+        None
+
+    Examples
+    --------
+    >>> seapy.roms.analysis.gen_derived("ocean_his.nc", "ocean_vort.nc",
+    ...                                 ["vorticity", "okubo_weiss"])
+    """
+    if fields is None:
+        fields = list(derived_fields)
+    for f in fields:
+        if f not in derived_fields:
+            raise ValueError("unknown derived field: " + f)
+    grid = seapy.model.asgrid(roms_file)
+    nc = seapy.netcdf(roms_file)
+    epoch, time_var = seapy.roms.get_reftime(nc)
+    if records is None:
+        records = np.arange(len(nc.variables[time_var]))
+    else:
+        records = np.atleast_1d(records)
+
+    # Build the output file
+    dims = {"ocean_time": 0, "eta_rho": grid.ln, "xi_rho": grid.lm}
+    fdims = "ocean_time, eta_rho, xi_rho"
+    if nc.variables[velocity[0]].ndim == 4:
+        dims["s_rho"] = nc.variables[velocity[0]].shape[1]
+        fdims = "ocean_time, s_rho, eta_rho, xi_rho"
+    vars = [{"name": "ocean_time", "type": "f8", "dims": "ocean_time",
+             "attr": {"long_name": "time since initialization",
+                      "units": "seconds since " + str(epoch)}}] + \
+        [{"name": f, "type": "f4", "dims": fdims, "attr": derived_fields[f]}
+         for f in fields]
+    ncout = seapy.roms.ncgen.ncgen(derived_file, dims=dims, vars=vars,
+                                   clobber=clobber,
+                                   title="derived from " + str(roms_file))
+    start = len(ncout.variables["ocean_time"])
+
+    # Compute the fields of each chunk of records
+    for n in track(range(0, records.size, chunk),
+                   description="compute derived fields"):
+        recs = records[n:n + chunk]
+        out = slice(start + n, start + n + recs.size)
+        ncout.variables["ocean_time"][out] = seapy.roms.date2num(
+            seapy.roms.num2date(nc, time_var, recs), ncout, "ocean_time")
+        vals = derived(grid, nc.variables[velocity[0]][recs, ...],
+                       nc.variables[velocity[1]][recs, ...], fields)
+        for f in fields:
+            ncout.variables[f][out, ...] = vals[f]
+        ncout.sync()
+    ncout.close()
+    nc.close()
+
+
+def gen_omega(roms_file, omega_file, records=None, wvel=True, chunk=10,
+              clobber=False):
+    """
+    Compute the vertical velocity from the records of a ROMS history (or
+    average) file and store it into a new file. The records are read,
+    computed, and written in chunks, so the full 4D fields are never held
+    in memory.
+
+    Parameters
+    ----------
+    roms_file: string or list of strings,
+        The ROMS (history or average) file with u, v, and zeta. If it is a
+        list of strings, a netCDF4.MFDataset is opened instead.
+    omega_file: string,
+        The name of the file to store the vertical velocity fields
+    records: ndarray, optional
+        List of records to compute. Default is all records.
+    wvel: bool, optional
+        If True, compute the "true" vertical velocity, w, in addition to
+        omega.
+    chunk: int, optional
+        The number of records to compute at a time
+    clobber: bool, optional
+        If True, clobber any existing omega_file
+
+    Returns
+    -------
+        None
+
+    Examples
+    --------
+    >>> seapy.roms.analysis.gen_omega("ocean_his.nc", "ocean_omega.nc")
+    """
+    # Open the ROMS info
+    grid = seapy.model.asgrid(roms_file)
+    nc = seapy.netcdf(roms_file)
+    epoch, time_var = seapy.roms.get_reftime(nc)
+    if records is None:
+        records = np.arange(len(nc.variables[time_var]))
+    else:
+        records = np.atleast_1d(records)
+
+    # Build the output file
+    ncout = seapy.roms.ncgen.create_omega(omega_file,
+                                          eta_rho=grid.ln, xi_rho=grid.lm,
+                                          s_rho=grid.n, reftime=epoch,
+                                          clobber=clobber,
+                                          title="omega from " + str(roms_file))
+    grid.to_netcdf(ncout)
+    start = len(ncout.variables["ocean_time"])
+
+    # Compute each chunk of records
+    for n in track(range(0, records.size, chunk),
+                   description="compute vertical velocity"):
+        recs = records[n:n + chunk]
+        out = slice(start + n, start + n + recs.size)
+        u = nc.variables["u"][recs, ...]
+        v = nc.variables["v"][recs, ...]
+        W, z_r, z_w, thick_u, thick_v = seapy.roms.omega(
+            grid, u, v, nc.variables["zeta"][recs, ...], scale=True,
+            work=True)
+        ncout.variables["ocean_time"][out] = seapy.roms.date2num(
+            seapy.roms.num2date(nc, time_var, recs), ncout, "ocean_time")
+        ncout.variables["omega"][out, ...] = W
+        if wvel:
+            ncout.variables["w"][out, ...] = seapy.roms.lib._wvelocity(
+                grid, u, v, W, z_r, z_w, thick_u, thick_v)
         ncout.sync()
     ncout.close()
     nc.close()
@@ -122,8 +122,49 @@ def stretching(vstretching=2, theta_s=2, theta_b=0.1, hc=100, s_rho=10,
     return s, cs
 
 
+def _zcoeffs(vtransform, h, hc, scoord, stretching):
+    """
+    PRIVATE method: compute the factors of the depths of all levels that
+    do not depend upon zeta
+    """
+    shp = (scoord.size,) + (1,) * h.ndim
+    scoord = scoord.reshape(shp)
+    stretching = stretching.reshape(shp)
+    if vtransform == 1:
+        z0 = hc * (scoord - stretching) + stretching * h
+        return z0, 1.0 + z0 * (1 / h)
+    elif vtransform == 2:
+        return 1 / (hc + h), hc * scoord + h * stretching
+    else:
+        raise ValueError("transform value must be between 1 and 2")
+
+
+def _zlevels(vtransform, h, coeffs, zeta, out):
+    """
+    PRIVATE method: compute the depths of all levels at once into out,
+    broadcasting the levels against zeta. zeta may have a leading record
+    dimension and a level dimension of size one.
+    """
+    if vtransform == 1:
+        z0, cff = coeffs
+        np.multiply(zeta, cff, out=out)
+        out += z0
+    else:
+        cff, cff1 = coeffs
+        np.multiply((zeta + h) * cff, cff1, out=out)
+        out += zeta
+
+
+def _zrecords(zeta, h):
+    """
+    PRIVATE method: return the number of records of zeta, or None if
+    zeta has no record dimension
+    """
+    return zeta.shape[0] if np.ndim(zeta) > np.ndim(h) else None
+
+
 def depth(vtransform=1, h=None, hc=100, scoord=None,
-          stretching=None, zeta=0, w_grid=False):
+          stretching=None, zeta=0, w_grid=False, chunk=10):
     """
     Solve the depth of the given bathymetry in s-levels.
 
@@ -140,14 +181,18 @@ def depth(vtransform=1, h=None, hc=100, scoord=None,
     stretching: array
         stretching values from stretching method
     zeta: array
-        sea surface height to add to bottom
+        sea surface height to add to bottom. If zeta has a leading record
+        dimension (e.g., [time, eta, xi]), the depths of each record are
+        returned. zeta may be a netCDF variable, which is read in chunks.
     w_grid: bool, optional
         solve stretching on the w-grid
+    chunk: int, optional
+        number of zeta records to compute at a time
 
     Returns
     -------
     z: ndarray,
-      depth of grid cells
+      depth of grid cells [record, N, ...]
 
     """
     if h is None or scoord is None or stretching is None:
@@ -156,35 +201,31 @@ def depth(vtransform=1, h=None, hc=100, scoord=None,
         raise ValueError(
             "the stretching and scoord arrays must be the same size")
     N = scoord.size
-    hinv = 1 / h
-    h = np.asanyarray(h)
-    wk = 0
-    r = range(N)
-    if w_grid:
-        N = N + 1
-        wk = 1
-    z = np.zeros(np.hstack((N, h.shape)))
-
-    if vtransform == 1:
-        cff = hc * (scoord - stretching)
-        for k in r:
-            z0 = cff[k] + stretching[k] * h
-            z[k + wk, :] = z0 + zeta * (1.0 + z0 * hinv)
-    elif vtransform == 2:
-        cff = 1 / (hc + h)
-        for k in r:
-            cff1 = hc * scoord[k] + h * stretching[k]
-            z[k + wk, :] = zeta + (zeta + h) * cff * cff1
+    h = np.ma.getdata(h)
+    coeffs = _zcoeffs(vtransform, h, hc, np.asarray(scoord),
+                      np.asarray(stretching))
+    wk = 1 if w_grid else 0
+    nrec = _zrecords(zeta, h)
+
+    if nrec is None:
+        z = np.zeros(np.hstack((N + wk, h.shape)))
+        _zlevels(vtransform, h, coeffs, np.ma.getdata(zeta), z[wk:])
+        if w_grid:
+            z[0, :] = -h
     else:
-        raise ValueError("transform value must be between 1 and 2")
-    if w_grid:
-        z[0, :] = -h
+        z = np.zeros(np.hstack((nrec, N + wk, h.shape)))
+        for n in range(0, nrec, chunk):
+            l = slice(n, min(n + chunk, nrec))
+            _zlevels(vtransform, h, coeffs,
+                     np.ma.getdata(zeta[l])[:, np.newaxis, ...], z[l, wk:])
+        if w_grid:
+            z[:, 0, :] = -h
 
     return z
 
 
 def thickness(vtransform=1, h=None, hc=100, scoord=None,
-              stretching=None, zeta=0):
+              stretching=None, zeta=0, chunk=10):
     """
     Get the thickness of the grid cells for the given sigma-parameters.
 
@@ -201,18 +242,112 @@ def thickness(vtransform=1, h=None, hc=100, scoord=None,
     stretching: array
         stretching values from stretching method
     zeta: array
-        sea surface height to add to bottom
+        sea surface height to add to bottom. If zeta has a leading record
+        dimension (e.g., [time, eta, xi]), the thickness of each record is
+        returned. zeta may be a netCDF variable, which is read in chunks.
+    chunk: int, optional
+        number of zeta records to compute at a time
+
+    Returns
+    -------
+    hz : array,
+      thickness [record, N, ...]
+    """
+    nrec = _zrecords(zeta, np.ma.getdata(h))
+    if nrec is None:
+        # Get the w-coordinate depths and return the difference
+        z_w = depth(vtransform, h, hc, scoord, stretching, zeta, True)
+        return z_w[1:, ...] - z_w[0:-1, ...]
+
+    hz = np.zeros(np.hstack((nrec, scoord.size, np.shape(h))))
+    for n in range(0, nrec, chunk):
+        l = slice(n, min(n + chunk, nrec))
+        z_w = depth(vtransform, h, hc, scoord, stretching, zeta[l], True,
+                    chunk)
+        hz[l] = z_w[:, 1:, ...] - z_w[:, 0:-1, ...]
+    return hz
+
+
+def depth_records(vtransform=1, h=None, hc=100, scoord=None,
+                  stretching=None, zeta=None, w_grid=False, records=None):
+    """
+    Iterate over the depths of the given bathymetry in s-levels for each
+    record of the sea surface height. Only a single record is read and held
+    in memory at a time.
+
+    Parameters
+    ----------
+    vtransform : int, optional
+        transform algorithm type
+    h: array, optional
+        value of bottom depths
+    hc: int, optional
+        critical depth
+    scoord: array
+        s coordinates from stretching method
+    stretching: array
+        stretching values from stretching method
+    zeta: array or netCDF4.Variable
+        sea surface height [record, ...] to add to bottom
     w_grid: bool, optional
         solve stretching on the w-grid
+    records: list, optional
+        records of zeta to use. Default is all records.
 
     Returns
     -------
-    hz : array,
-      thickness
+    z: generator of ndarray,
+      depth of grid cells [N, ...] for each record
+
+    Examples
+    --------
+    >>> nc = netCDF4.Dataset('ocean_his.nc')
+    >>> for z in seapy.roms.depth_records(grid.vtransform, grid.h, grid.hc,
+    ...                                    grid.s_rho, grid.cs_r,
+    ...                                    nc.variables['zeta']):
+    ...     print(z.min())
     """
-    # Get the w-coordinate depths and return the differenc
-    z_w = depth(vtransform, h, hc, scoord, stretching, zeta, True)
-    return z_w[1:, :, :] - z_w[0:-1, :, :]
+    if zeta is None:
+        raise AttributeError("you must supply zeta")
+    records = range(zeta.shape[0]) if records is None else records
+    for n in records:
+        yield depth(vtransform, h, hc, scoord, stretching, zeta[n], w_grid)
+
+
+def thickness_records(vtransform=1, h=None, hc=100, scoord=None,
+                      stretching=None, zeta=None, records=None):
+    """
+    Iterate over the thickness of the grid cells for each record of the sea
+    surface height. Only a single record is read and held in memory at a
+    time.
+
+    Parameters
+    ----------
+    vtransform : int, optional
+        transform algorithm type
+    h: array, optional
+        value of bottom depths
+    hc: int, optional
+        critical depth
+    scoord: array
+        s coordinates from stretching method
+    stretching: array
+        stretching values from stretching method
+    zeta: array or netCDF4.Variable
+        sea surface height [record, ...] to add to bottom
+    records: list, optional
+        records of zeta to use. Default is all records.
+
+    Returns
+    -------
+    hz : generator of ndarray,
+      thickness [N, ...] for each record
+    """
+    if zeta is None:
+        raise AttributeError("you must supply zeta")
+    records = range(zeta.shape[0]) if records is None else records
+    for n in records:
+        yield thickness(vtransform, h, hc, scoord, stretching, zeta[n])
 
 
 def gen_boundary_region(shp, north=None, east=None, west=None, south=None,
@@ -315,6 +450,38 @@ def _get_calendar(var):
     return calendar_types[default], calendar_conv[default]
 
 
+# Seconds in each of the time units that may be used in netCDF files
+_time_units = {"microseconds": 1e-6, "microsecond": 1e-6, "us": 1e-6,
+               "milliseconds": 1e-3, "millisecond": 1e-3, "ms": 1e-3,
+               "seconds": 1, "second": 1, "secs": 1, "sec": 1, "s": 1,
+               "minutes": 60, "minute": 60, "mins": 60, "min": 60,
+               "hours": 3600, "hour": 3600, "hrs": 3600, "hr": 3600,
+               "h": 3600, "days": 86400, "day": 86400, "d": 86400}
+
+
+def _get_timebase(var, calendar):
+    """
+    PRIVATE method: return the number of nanoseconds per unit and the
+    reference time (as datetime64[ns]) of a netcdf time variable, or None
+    if the times cannot be converted arithmetically (non-standard
+    calendars or dates outside of the datetime64[ns] range, which also
+    excludes the Julian dates of the standard calendar).
+    """
+    if calendar not in ('standard', 'gregorian', 'proleptic_gregorian'):
+        return None
+    try:
+        unit = var.units.split(" since ")[0].strip().lower()
+        ref = netCDF4.num2date(0, var.units, calendar=calendar,
+                               only_use_cftime_datetimes=False)
+        ref = np.datetime64(ref.replace(tzinfo=None), "us")
+    except (AttributeError, ValueError, TypeError):
+        return None
+    if unit not in _time_units or not \
+            np.datetime64("1678-01-01") < ref < np.datetime64("2262-01-01"):
+        return None
+    return int(_time_units[unit] * 1e9), ref.astype("datetime64[ns]")
+
+
 def date2num(dates, nc, tvar=None):
     """
     Convert the datetime vector to number for the given netcdf files
@@ -323,8 +490,9 @@ def date2num(dates, nc, tvar=None):
 
     Parameters
     ----------
-    dates : array of datetime.datetime
-      Values to convert
+    dates : array of datetime.datetime or numpy.datetime64
+      Values to convert. Arrays of datetime64 are converted in a single
+      vectorized operation for the standard calendars.
     nc : netCDF4.Dataset,
       netcdf input file
     tvar : string, optional
@@ -340,18 +508,30 @@ def date2num(dates, nc, tvar=None):
     tvar = tvar if tvar else get_timevar(nc)
 
     calendar, _ = _get_calendar(nc.variables[tvar])
+    if np.asarray(dates).dtype.kind == "M":
+        base = _get_timebase(nc.variables[tvar], calendar)
+        if base is not None:
+            return (np.asarray(dates, dtype="datetime64[ns]") - base[1]) / \
+                np.timedelta64(base[0], "ns")
+        dates = np.asarray(dates, dtype="datetime64[us]").astype(object)
+
     # Convert the times
     return netCDF4.date2num(dates,
                             nc.variables[tvar].units,
                             calendar=calendar)
 
 
-def num2date(nc, tvar=None, records=None, as_datetime=True, epoch=None):
+def num2date(nc, tvar=None, records=None, as_datetime=True, epoch=None,
+             as_datetime64=False):
     """
     Load the time vector from a netCDF file as a datetime array, accounting
     for units and the calendar type used. This is a wrapper to the
     netCDF4.num2date function to account for calendar strangeness in ROMS
 
+    For the standard calendars, the times are converted in a single
+    vectorized operation from the reference time of the file rather than
+    one at a time.
+
     Parameters
     ----------
     nc : netCDF4.Dataset,
@@ -366,6 +546,9 @@ def num2date(nc, tvar=None, records=None, as_datetime=True, epoch=None):
     epoch : datetime.datetime, optional
       if you would like the values relative to an epoch, then
       specify the epoch to remove.
+    as_datetime64 : boolean, optional
+      If True, return the times as an array of numpy.datetime64[ns]
+      rather than datetime objects.
 
     Returns
     -------
@@ -382,13 +565,34 @@ def num2date(nc, tvar=None, records=None, as_datetime=True, epoch=None):
         return list()
     calendar, convert = _get_calendar(nc.variables[tvar])
 
+    # For the standard calendars, offset the reference time by the times
+    base = _get_timebase(nc.variables[tvar], calendar)
+    if base is not None and (as_datetime or as_datetime64 or epoch):
+        vals = np.atleast_1d(np.ma.getdata(
+            nc.variables[tvar][records])).astype(np.float64)
+        whole = np.floor(vals)
+        times = base[1] + (whole.astype(np.int64) * base[0] +
+                           np.round((vals - whole) * base[0]).astype(
+                               np.int64)).astype("timedelta64[ns]")
+        if as_datetime64 and not epoch:
+            return times
+
+        # Match the datetime conversion below: round to microseconds and
+        # keep the whole seconds
+        times = (times + np.timedelta64(500, "ns")).astype(
+            "datetime64[us]").astype("datetime64[s]")
+        if epoch:
+            return (times - np.datetime64(epoch, "us")) / \
+                np.timedelta64(1, "s") * secs2day
+        return times.astype(object)
+
     # Load the times
     times = np.atleast_1d(netCDF4.num2date(nc.variables[tvar][records],
                                            nc.variables[tvar].units,
                                            calendar=calendar))
 
     # If we don't have datetime instances, convert to datetime if we can
-    if (as_datetime or convert) and \
+    if (as_datetime or as_datetime64 or convert) and \
        (not isinstance(times[0], datetime.datetime)
             and times[0].datetime_compatible):
         times = np.array([datetime.datetime.strptime(
@@ -397,7 +601,7 @@ def num2date(nc, tvar=None, records=None, as_datetime=True, epoch=None):
             times])
 
     if not epoch:
-        return times
+        return times.astype("datetime64[ns]") if as_datetime64 else times
     else:
         return np.asarray([(t - epoch).total_seconds() * secs2day for t in times])
 
@@ -500,27 +704,19 @@ def omega(grid, u, v, zeta=0, scale=True, work=False):
     while zeta.ndim < 3:
         zeta=zeta[np.newaxis, ...]
 
-    # Get the model grid parameters for the given thickness
-    thick_u=u * 0
-    thick_v=v * 0
-    z_r=np.ma.zeros((u.shape[0], u.shape[1], zeta.shape[1], zeta.shape[2]))
-    z_w=np.ma.zeros((u.shape[0], u.shape[1] + 1,
-                       zeta.shape[1], zeta.shape[2]))
-    for i in range(zeta.shape[0]):
-        s_w, cs_w=seapy.roms.stretching(
-            grid.vstretching, grid.theta_s, grid.theta_b, grid.hc,
-            grid.n, w_grid=True)
-        z_r[i, ...]=seapy.roms.depth(grid.vtransform, grid.h, grid.hc,
-                                       s_w, cs_w, zeta=zeta[i, ...],
-                                       w_grid=False)
-        z_w[i, ...]=seapy.roms.depth(grid.vtransform, grid.h, grid.hc,
-                                       s_w, cs_w, zeta=zeta[i, ...],
-                                       w_grid=True)
-        thick_rho=np.squeeze(z_w[i, 1:, :, :] - z_w[i, :-1, :, :])
-        thick_u[i, ...]=seapy.model.rho2u(thick_rho)
-        thick_v[i, ...]=seapy.model.rho2v(thick_rho)
-    z_r[z_r > 50000]=np.ma.masked
-    z_w[z_w > 50000]=np.ma.masked
+    # Get the model grid parameters for the given thickness. The depths of
+    # all records are computed at once from a single set of stretching
+    s_w, cs_w = seapy.roms.stretching(
+        grid.vstretching, grid.theta_s, grid.theta_b, grid.hc,
+        grid.n, w_grid=True)
+    z_w = np.ma.array(depth(grid.vtransform, grid.h, grid.hc, s_w, cs_w,
+                            zeta=zeta, w_grid=True))
+    z_r = z_w[:, 1:, :, :].copy()
+    thick_rho = z_w[:, 1:, :, :] - z_w[:, :-1, :, :]
+    thick_u = seapy.model.rho2u(thick_rho)
+    thick_v = seapy.model.rho2v(thick_rho)
+    z_r[z_r > 50000] = np.ma.masked
+    z_w[z_w > 50000] = np.ma.masked
 
     # Compute W (omega)
     Huon=u * thick_u * seapy.model.rho2u(grid.dn)
@@ -580,6 +776,14 @@ def wvelocity(grid, u, v, zeta=0):
     W, z_r, z_w, thick_u, thick_v=omega(grid, u, v, zeta, scale=True,
                                           work=True)
 
+    return _wvelocity(grid, u, v, W, z_r, z_w, thick_u, thick_v)
+
+
+def _wvelocity(grid, u, v, W, z_r, z_w, thick_u, thick_v):
+    """
+    PRIVATE method: compute the "true" vertical velocity from omega and
+    its work arrays
+    """
     # Compute quasi-horizontal motions (Ui + Vj)*GRAD s(z)
     vert=z_r * 0
     # U-contribution
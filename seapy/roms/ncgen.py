@@ -909,6 +909,54 @@ def create_ini(filename, eta_rho=10, xi_rho=10, s_rho=1,
     return _nc
 
 
+def create_omega(filename, eta_rho=10, xi_rho=10, s_rho=1,
+                 reftime=default_epoch, clobber=False, cdl=None,
+                 title="My Omega"):
+    """
+    Create a vertical velocity file for omega and w
+
+    Parameters
+    ----------
+    filename : string
+        name and path of file to create
+    eta_rho: int, optional
+        number of rows in the eta direction
+    xi_rho: int, optional
+        number of columns in the xi direction
+    s_rho: int, optional
+        number of s-levels
+    reftime: datetime, optional
+        date of epoch for time origin in netcdf
+    clobber: bool, optional
+        If True, clobber any existing files and recreate. If False, use
+        the existing file definition
+    cdl: string, optional,
+        Use the specified CDL file as the definition for the new
+        netCDF file.
+    title: string, optional
+        netcdf attribute title
+
+    Returns
+    -------
+    nc, netCDF4 object
+
+    """
+    # Generate the Structure
+    dims, vars, attr = cdl_parser(
+        _cdl_dir + "roms_omega.cdl" if cdl is None else cdl)
+
+    # Fill in the appropriate dimension values
+    dims = _set_grid_dimensions(dims, eta_rho, xi_rho, s_rho)
+    vars = _set_time_ref(vars, "ocean_time", reftime)
+
+    # Create the file
+    _nc = ncgen(filename, dims=dims, vars=vars, attr=attr, clobber=clobber,
+                title=title)
+
+    # Return the new file
+    return _nc
+
+
 def create_nudge_coef(filename, eta_rho=10, xi_rho=10, s_rho=1, clobber=False,
                       cdl=None, title="My Nudging"):
     """
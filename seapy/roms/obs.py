@@ -25,14 +25,23 @@
 
 import numpy as np
 import netCDF4
+import scipy.spatial
 import seapy
 from collections import namedtuple
+from joblib import Parallel, delayed
 from warnings import warn
 from rich.progress import track
 
 # Define a named tuple to store raw data for the gridder
 raw_data = namedtuple('raw_data', 'type provenance values error min_error')
 
+# The fields of each observation
+_obs_fields = ("time", "x", "y", "z", "lat", "lon", "depth", "value",
+               "error", "type", "provenance", "meta")
+_obs_variables = {"x": "Xgrid", "y": "Ygrid", "z": "Zgrid"}
+# Mean radius of the earth [m] for searching the obs on the sphere
+_earth_radius = 6371000.0
+
 # Define the observation type
 obs_types = {
     1: "ZETA",
@@ -132,6 +141,48 @@ def _provenance_from_string(s):
         return int(s)
 
 
+def _survey_starts(times, dt):
+    """
+    PRIVATE method: Given the sorted unique times of the observations,
+    repeatedly merge the closest pair of neighboring surveys (the later into
+    the earlier) until all surveys are at least dt apart. Return True for
+    each time that starts a survey.
+    """
+    import heapq
+
+    n = times.size
+    first = np.ones(n, dtype=bool)
+    after = np.arange(1, n + 1)
+    gaps = np.diff(times)
+    close = np.nonzero(gaps < dt)[0]
+    heap = list(zip(gaps[close], close, close + 1))
+    heapq.heapify(heap)
+    while heap:
+        gap, k, nxt = heapq.heappop(heap)
+        # Skip the pairs that have since been merged
+        if not first[k] or after[k] != nxt:
+            continue
+        first[nxt] = False
+        after[k] = after[nxt]
+        if after[k] < n:
+            gap = times[after[k]] - times[k]
+            if gap < dt:
+                heapq.heappush(heap, (gap, k, after[k]))
+    return first
+
+
+def _unit_sphere(lon, lat):
+    """
+    Internal function to convert lon/lat [degrees] to positions on the unit
+    sphere
+    """
+    lon = np.radians(np.ma.getdata(lon)).ravel()
+    lat = np.radians(np.ma.getdata(lat)).ravel()
+    pts = np.vstack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon),
+                     np.sin(lat))).T
+    return pts[0] if pts.shape[0] == 1 else pts
+
+
 def asobs(obs):
     """
     Return the input as an observation array if possible. If the parameter
@@ -201,7 +252,8 @@ class obs:
     def __init__(self, filename=None, time=None, x=None, y=None, z=None,
                  lat=None, lon=None, depth=None, value=None, error=None,
                  type=None, provenance=None, meta=None,
-                 title="ROMS Observations"):
+                 title="ROMS Observations", window=None, surveys=None,
+                 fields=None):
         """
         Class to deal with ROMS observations for data assimilation
 
@@ -233,38 +285,30 @@ class obs:
           obs provenance
         meta : ndarray, optional,
           obs additional information
+        window : tuple, optional,
+          if loading from a file, only load the surveys with times within
+          the (start, end) days, including start but not end. Only the
+          observations of those surveys are read from the file.
+        surveys : slice or list, optional,
+          if loading from a file, only load the given surveys
+        fields : list of str, optional,
+          if loading from a file, only read these fields (e.g., ["time",
+          "x", "y", "value"]); the others are filled with zeros
         """
         self.title = title
         if filename is not None:
-            nc = seapy.netcdf(filename)
             # Construct an array from the data in the file. If obs_meta
             # exists in the file, then load it; otherwise, fill with zeros
             self.filename = filename
-            self.time = nc.variables["obs_time"][:]
-            self.x = nc.variables["obs_Xgrid"][:]
-            self.y = nc.variables["obs_Ygrid"][:]
-            self.z = nc.variables["obs_Zgrid"][:]
-            self.lat = nc.variables["obs_lat"][:]
-            self.lon = nc.variables["obs_lon"][:]
-            self.depth = nc.variables["obs_depth"][:]
-            self.value = nc.variables["obs_value"][:]
-            self.error = nc.variables["obs_error"][:]
-            self.type = nc.variables["obs_type"][:]
-            self.provenance = nc.variables["obs_provenance"][:]
-            # Update the provenance definitions
-            try:
-                obs_provenance.update(dict((int(k.strip()), v.strip())
-                                           for v, k in
-                                           (it.split(':') for it in
-                                            nc.obs_provenance.split(','))))
-            except (AttributeError, ValueError):
-                pass
-            try:
-                self.meta = nc.variables["obs_meta"][:]
-            except KeyError:
-                self.meta = np.zeros(self.value.size)
-            finally:
-                nc.close()
+            if (window is not None or surveys is not None) and \
+                    not isinstance(filename, str):
+                parts = [obs(f, window=window, surveys=surveys, fields=fields)
+                         for f in filename]
+                for f in _obs_fields:
+                    setattr(self, f, np.ma.concatenate(
+                        [getattr(p, f) for p in parts]))
+            else:
+                self._load(filename, window, surveys, fields)
         else:
             self.filename = None
             if time is not None:
@@ -295,6 +339,66 @@ class obs:
                 self.meta = np.atleast_1d(meta)
             self._consistent()
 
+    def _load(self, filename, window=None, surveys=None, fields=None):
+        """
+        PRIVATE method: load the observations from a file. If a window or
+        surveys are given, only the observations of the selected surveys are
+        read (using the number of observations in each survey); if fields
+        are given, only those variables are read.
+        """
+        nc = seapy.netcdf(filename)
+        runs = [np.s_[:]]
+        keep = None
+        if window is not None or surveys is not None:
+            survey_time = nc.variables["survey_time"][:]
+            offset = np.concatenate(
+                ([0], np.cumsum(nc.variables["Nobs"][:].astype(int))))
+            select = np.zeros(survey_time.size, dtype=bool)
+            select[np.s_[:] if surveys is None else surveys] = True
+            if window is not None:
+                select &= np.logical_and(survey_time >= window[0],
+                                         survey_time < window[1])
+            idx = np.nonzero(select)[0]
+            # Read each run of adjacent surveys as a single slice; reading
+            # a list of indices from netCDF4 is done one value at a time
+            runs = [np.s_[offset[r[0]]:offset[r[-1] + 1]] for r in
+                    np.split(idx, np.nonzero(np.diff(idx) != 1)[0] + 1)
+                    if r.size]
+            if len(runs) > 1:
+                # If the selection fills most of its span, read the span
+                # and select in memory rather than reading many slices
+                span = np.s_[runs[0].start:runs[-1].stop]
+                count = sum(r.stop - r.start for r in runs)
+                if 2 * count >= span.stop - span.start:
+                    keep = np.concatenate([np.arange(r.start, r.stop)
+                                           for r in runs]) - span.start
+                    runs = [span]
+        size = sum(len(range(*r.indices(len(nc.variables["obs_time"]))))
+                   for r in runs) if keep is None else keep.size
+
+        for f in _obs_fields:
+            var = "obs_" + _obs_variables.get(f, f)
+            if (fields is None or f in fields) and var in nc.variables \
+                    and size:
+                val = np.ma.concatenate([nc.variables[var][r] for r in runs]) \
+                    if len(runs) > 1 else nc.variables[var][runs[0]]
+                setattr(self, f, val if keep is None else val[keep])
+            elif (fields is None or f in fields) and var in nc.variables:
+                setattr(self, f, np.zeros(0, dtype=nc.variables[var].dtype))
+            else:
+                setattr(self, f, np.zeros(
+                    size, dtype=int if f in ("type", "provenance") else float))
+
+        # Update the provenance definitions
+        try:
+            obs_provenance.update(dict((int(k.strip()), v.strip())
+                                       for v, k in
+                                       (it.split(':') for it in
+                                        nc.obs_provenance.split(','))))
+        except (AttributeError, ValueError):
+            pass
+        nc.close()
+
     def _consistent(self):
         """
         PRIVATE method: try to make the structure self-consistent. Throw
@@ -338,7 +442,7 @@ class obs:
             np.isfinite(self.error),
             np.isfinite(self.time)))
         if np.any(~good_vals):
-            self.delete(np.where(good_vals == False))
+            self.compress(good_vals)
 
         # Set the shape parameter
         self.shape = self.value.shape
@@ -351,6 +455,19 @@ class obs:
         return self.value.size
 
     def __getitem__(self, l):
+        # Slices are views of the same arrays: no data are copied, and
+        # changes to the values of either are shared. Methods that change
+        # the observations (e.g., create_survey) replace the arrays instead.
+        if isinstance(l, (int, np.integer)):
+            l = slice(l, l + 1 if l != -1 else None)
+        if isinstance(l, slice):
+            view = obs.__new__(obs)
+            view.title = self.title
+            view.filename = None
+            for f in _obs_fields:
+                setattr(view, f, getattr(self, f)[l])
+            view.shape = view.value.shape
+            return view
         return obs(time=self.time[l], x=self.x[l], y=self.y[l],
                    z=self.z[l], lon=self.lon[l], lat=self.lat[l],
                    depth=self.depth[l], value=self.value[l],
@@ -456,18 +573,35 @@ class obs:
         Delete every other observation
         >>> myobs.delete(np.s_[::2])
         """
-        self.time = np.delete(self.time, obj)
-        self.x = np.delete(self.x, obj)
-        self.y = np.delete(self.y, obj)
-        self.z = np.delete(self.z, obj)
-        self.lat = np.delete(self.lat, obj)
-        self.lon = np.delete(self.lon, obj)
-        self.depth = np.delete(self.depth, obj)
-        self.value = np.delete(self.value, obj)
-        self.error = np.delete(self.error, obj)
-        self.type = np.delete(self.type, obj)
-        self.provenance = np.delete(self.provenance, obj)
-        self.meta = np.delete(self.meta, obj)
+        keep = np.ones(self.value.size, dtype=bool)
+        keep[obj] = False
+        self.compress(keep)
+
+    def compress(self, keep):
+        """
+        keep only the selected observations, applying the selection to all
+        of the fields at once.
+
+        Parameters
+        ----------
+        keep : ndarray of bool
+            True for each observation to keep
+
+        Returns
+        -------
+        Nothing: updates the class arrays
+
+        Examples
+        --------
+        Keep only the temperature observations
+        >>> myobs.compress(myobs.type == 6)
+        """
+        keep = np.asarray(keep, dtype=bool)
+        if keep.all():
+            return
+        for f in _obs_fields:
+            setattr(self, f, getattr(self, f)[keep])
+        self.shape = self.value.shape
 
     def create_survey(self, dt=0):
         """
@@ -476,22 +610,19 @@ class obs:
         # Generate the sort list
         self.sort = np.argsort(self.time, kind='mergesort')
 
-        # Build the survey structure
-        times, counts = np.unique(self.time[self.sort], return_counts=True)
-
-        # Make sure everything is within dt
+        # Make sure everything is within dt by merging the surveys
         if dt:
-            delta = np.diff(times)
-            while np.any(delta < dt):
-                idx = np.argmin(delta)
-                self.time[self.time == times[idx + 1]] = times[idx]
-                times[idx + 1] = times[idx]
-                times = np.unique(times)
-                delta = np.diff(times)
-
-            # Re-sort the surveys
-            times, counts = np.unique(self.time[self.sort], return_counts=True)
+            times, inverse = np.unique(self.time, return_inverse=True)
+            first = _survey_starts(times, dt)
+            if not first.all():
+                idx = np.maximum.accumulate(
+                    np.where(first, np.arange(times.size), 0))
+                # Replace rather than assign into the times, which may be
+                # shared with the obs this is a view of
+                self.time = times[idx][inverse.ravel()]
 
+        # Build the survey structure
+        times, counts = np.unique(self.time[self.sort], return_counts=True)
         self.survey_time = times
         self.nobs = counts
 
@@ -557,8 +688,315 @@ class obs:
         nc.close()
 
 
+class obs_builder:
+
+    def __init__(self, title="ROMS Observations", capacity=1024):
+        """
+        Class to efficiently accumulate many batches of observations (from
+        obs, files, or arrays) into a single obs. The fields are stored in
+        arrays whose capacity is doubled as needed, so that adding many
+        batches is linear in the number of observations rather than copying
+        all of the observations with each batch as obs.add does.
+
+        Parameters
+        ----------
+        title : string, optional,
+          title of the resulting observations
+        capacity : int, optional,
+          initial number of observations to reserve space for
+
+        Examples
+        --------
+        >>> build = obs_builder()
+        >>> for f in files:
+        ...     build.add(f)
+        >>> build.add(time=4, x=3.2, y=2.8, z=0, value=23.44, error=0.5,
+        ...           type="temp", provenance="glider")
+        >>> myobs = build.to_obs()
+        """
+        self.title = title
+        self._capacity = capacity
+        self._data = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, new_obs=None, **kwargs):
+        """
+        Add a batch of observations
+
+        Parameters
+        ----------
+        new_obs : obs, string, or list, optional,
+          observations (or the filename of observations) to add
+        **kwargs : ndarray, optional,
+          if new_obs is not given, the fields of the observations to add as
+          for obs (time, x, y, z, lat, lon, depth, value, error, type,
+          provenance, meta)
+
+        Returns
+        -------
+        None
+        """
+        if new_obs is None:
+            new_obs = obs(**kwargs)
+        else:
+            new_obs = asobs(new_obs)
+            new_obs._consistent()
+        n = new_obs.value.size
+        if not n:
+            return
+
+        # Grow the storage as needed
+        if self._data is None:
+            cap = max(self._capacity, n)
+            self._data = {f: np.empty(cap, dtype=np.asarray(
+                getattr(new_obs, f)).dtype) for f in _obs_fields}
+        elif self._size + n > self._data["value"].size:
+            cap = max(2 * self._data["value"].size, self._size + n)
+            for f in _obs_fields:
+                grown = np.empty(cap, dtype=self._data[f].dtype)
+                grown[:self._size] = self._data[f][:self._size]
+                self._data[f] = grown
+
+        for f in _obs_fields:
+            val = np.ma.getdata(getattr(new_obs, f))
+            dtype = np.result_type(self._data[f], val)
+            if dtype != self._data[f].dtype:
+                self._data[f] = self._data[f].astype(dtype)
+            self._data[f][self._size:self._size + n] = val
+        self._size += n
+
+    def to_obs(self):
+        """
+        Create the obs from all of the batches that were added. The builder
+        is emptied.
+
+        Returns
+        -------
+        obs : obs,
+          the observations
+        """
+        if self._data is None:
+            return obs(title=self.title,
+                       **{f: np.array([]) for f in _obs_fields})
+        new_obs = obs(title=self.title, **{f: self._data[f][:self._size].copy()
+                                           for f in _obs_fields})
+        self._data = None
+        self._size = 0
+        return new_obs
+
+
+class obs_index:
+
+    def __init__(self, obs):
+        """
+        Class to index a set of observations in time and space for fast
+        queries of the observations within a time window, a lat/lon box, or
+        a distance of a location. Rather than comparing every observation to
+        each query, the observations are sorted by time and latitude and
+        held in a KD-tree on the sphere.
+
+        The index is built as needed: if observations are added to or deleted
+        from the obs, the index is rebuilt (in O(n log n)) upon the next
+        query. If the values of the obs are changed in place, call rebuild.
+
+        Parameters
+        ----------
+        obs : obs or string,
+          observations (or filename of the observations) to index
+
+        Examples
+        --------
+        Find the observations within 50 km of a mooring during a day
+
+        >>> idx = obs_index(myobs)
+        >>> near = myobs[idx.radius(-158.0, 21.5, 50000, window=(10, 11))]
+
+        Find the observations in a box over the first 3 days
+
+        >>> l = idx.box(-160, -155, 18, 22, window=(0, 3))
+        """
+        self.obs = asobs(obs)
+        self.rebuild()
+
+    def __len__(self):
+        return self._size
+
+    def rebuild(self):
+        """
+        Rebuild the index from the current observations.
+
+        Returns
+        -------
+        None
+        """
+        self._size = self.obs.value.size
+        time = np.ma.getdata(self.obs.time).ravel()
+        lat = np.ma.getdata(self.obs.lat).ravel()
+        self._time_order = np.argsort(time, kind="mergesort")
+        self._time = time[self._time_order]
+        # If the obs are already in time order (as read from a file), time
+        # windows are contiguous
+        self._sorted = bool(np.all(self._time_order == np.arange(self._size)))
+        self._lat_order = np.argsort(lat, kind="mergesort")
+        self._lat = lat[self._lat_order]
+        self._tree = None
+
+    def _current(self):
+        """
+        PRIVATE method: rebuild the index if the number of observations
+        has changed since it was built
+        """
+        if self.obs.value.size != self._size:
+            self.rebuild()
+
+    def _kdtree(self):
+        """
+        PRIVATE method: construct the KD-tree of the positions on the unit
+        sphere when it is first needed
+        """
+        if self._tree is None:
+            self._tree = scipy.spatial.cKDTree(_unit_sphere(
+                self.obs.lon, self.obs.lat), balanced_tree=False)
+        return self._tree
+
+    def _select(self, l, window):
+        """
+        PRIVATE method: restrict the list of observations to the time window
+        and return the sorted list
+        """
+        if window is not None:
+            time = np.ma.getdata(self.obs.time).ravel()[l]
+            l = l[np.logical_and(time >= window[0], time < window[1])]
+        return np.sort(l)
+
+    def window(self, start, end):
+        """
+        Find the observations within the time window
+
+        Parameters
+        ----------
+        start : float,
+          starting time of the window (inclusive)
+        end : float,
+          ending time of the window (exclusive)
+
+        Returns
+        -------
+        l : slice or ndarray,
+          the observations within the window. If the observations are in
+          time order, this is a slice so that obs[l] is a view rather than
+          a copy; otherwise, it is the sorted array of indices.
+        """
+        self._current()
+        l = np.searchsorted(self._time, (start, end))
+        if self._sorted:
+            return slice(l[0], l[1])
+        return np.sort(self._time_order[l[0]:l[1]])
+
+    def box(self, lon_min, lon_max, lat_min, lat_max, window=None):
+        """
+        Find the observations within the lat/lon box. The longitudes may
+        cross the dateline (lon_min > lon_max), and the longitudes of the
+        observations may use either the [-180, 180] or [0, 360] convention.
+
+        Parameters
+        ----------
+        lon_min : float,
+          western longitude of the box
+        lon_max : float,
+          eastern longitude of the box
+        lat_min : float,
+          southern latitude of the box
+        lat_max : float,
+          northern latitude of the box
+        window : tuple, optional,
+          (start, end) time window to restrict the observations to,
+          including start but not end as for window
+
+        Returns
+        -------
+        l : ndarray,
+          the sorted indices of the observations within the box
+        """
+        self._current()
+        l = self._lat_order[np.searchsorted(self._lat, lat_min, side="left"):
+                            np.searchsorted(self._lat, lat_max, side="right")]
+        lon = np.ma.getdata(self.obs.lon).ravel()[l]
+        l = l[np.mod(lon - lon_min, 360) <= np.mod(lon_max - lon_min, 360)]
+        return self._select(l, window)
+
+    def radius(self, lon, lat, distance, window=None):
+        """
+        Find the observations within a distance of a location
+
+        Parameters
+        ----------
+        lon : float,
+          longitude of the location
+        lat : float,
+          latitude of the location
+        distance : float,
+          distance [m] from the location
+        window : tuple, optional,
+          (start, end) time window to restrict the observations to,
+          including start but not end as for window
+
+        Returns
+        -------
+        l : ndarray,
+          the sorted indices of the observations within the distance
+        """
+        self._current()
+        # Search the sphere with a radius generous enough to cover the
+        # ellipsoid, then use the geodesic distance for the final selection
+        arc = min(np.pi, 1.01 * distance / _earth_radius)
+        l = np.array(self._kdtree().query_ball_point(
+            _unit_sphere(lon, lat), 2 * np.sin(arc / 2)), dtype=int)
+        l = self._select(l, window)
+        if not l.size:
+            return l
+        dist = seapy.earth_distance(lon, lat,
+                                    np.ma.getdata(self.obs.lon).ravel()[l],
+                                    np.ma.getdata(self.obs.lat).ravel()[l])
+        return l[dist <= distance]
+
+    def nearest(self, lon, lat, k=1):
+        """
+        Find the observations nearest to a location
+
+        Parameters
+        ----------
+        lon : float,
+          longitude of the location
+        lat : float,
+          latitude of the location
+        k : int, optional,
+          number of observations to find
+
+        Returns
+        -------
+        l : ndarray,
+          the indices of the nearest observations, from nearest to farthest
+        """
+        self._current()
+        _, l = self._kdtree().query(_unit_sphere(lon, lat), k=k)
+        # Missing neighbors (k larger than the obs) are returned as the size
+        l = np.atleast_1d(l)
+        l = l[l < self._size]
+        if l.size < 2:
+            return l
+        # Order the neighbors by the geodesic distance
+        dist = seapy.earth_distance(lon, lat,
+                                    np.ma.getdata(self.obs.lon).ravel()[l],
+                                    np.ma.getdata(self.obs.lat).ravel()[l])
+        return l[np.argsort(dist, kind="mergesort")]
+
+
 def gridder(grid, time, lon, lat, depth, data, dt, depth_adjust=False,
-            title='ROMS Observations'):
+            title='ROMS Observations', threads=1):
     """
     Construct an observations set from raw observations by placing them
     onto a grid.
@@ -581,8 +1019,8 @@ def gridder(grid, time, lon, lat, depth, data, dt, depth_adjust=False,
         corresponding latitude to each value in the data.
     depth : ndarray or None,
         depth of the observations. If None, then all values are placed on
-        the surface; otherwise, must be a corresponding depth for each
-        value in the data.
+        the surface; otherwise, must be a corresponding depth [m] for each
+        value in the data. Positive depths are made negative.
     data : list of named tuples of seapy.roms.obs.raw_data,
         This list is comprised of each set of observation data types that
         are to be gridded together. If there is only one type (e.g.,
@@ -608,6 +1046,9 @@ def gridder(grid, time, lon, lat, depth, data, dt, depth_adjust=False,
         same time. The units must be the same as the provided time.
     title : string, optional,
         Title to assign the observations structure for output
+    threads : int, optional,
+        Number of processes to grid the time bins with. The result is
+        identical to that of a single process.
 
     Returns
     -------
@@ -631,8 +1072,6 @@ def gridder(grid, time, lon, lat, depth, data, dt, depth_adjust=False,
 
     These will generate new observation structures from the raw data.
     """
-    from numpy_groupies import aggregate
-
     # Make sure the input is of the proper form
     grid = seapy.model.asgrid(grid)
     time = np.atleast_1d(time)
@@ -649,6 +1088,97 @@ def gridder(grid, time, lon, lat, depth, data, dt, depth_adjust=False,
         return None
     lat = lat[region_list]
     lon = lon[region_list]
+    if depth is not None:
+        # The obs depths are negative [m] (grid.ijk does not change them)
+        depth = -np.abs(np.atleast_1d(depth)[region_list])
+    if time.size == 1:
+        time = np.resize(time, lon.size)
+    else:
+        time = time[region_list]
+    # Separate the masks from the values and errors, so that the processes
+    # share plain arrays rather than receiving copies of masked arrays
+    masks = [np.ma.getmaskarray(v.values)[region_list]
+             if isinstance(v.values, np.ma.core.MaskedArray) else None
+             for v in data]
+    data = [v._replace(values=np.ma.getdata(v.values)[region_list],
+                       error=None if v.error is None else
+                       np.ma.getdata(v.error)[region_list]) for v in data]
+
+    # Put the data into dt-space. Each time bin is independent, so the bins
+    # are split into groups of (nearly) equal numbers of observations that
+    # are processed in parallel. The groups are in order of time, so the
+    # result is the same as processing all of the bins together.
+    tbins, tidx = np.unique(np.floor(time / dt), return_inverse=True)
+    tidx = tidx.ravel()
+    threads = int(max(1, min(threads, tbins.size)))
+    if threads > 1:
+        cum = np.cumsum(np.bincount(tidx))
+        edges = np.unique(np.hstack((0, np.searchsorted(
+            cum, cum[-1] * np.arange(1, threads) / threads) + 1, tbins.size)))
+        grid._index("rho")
+        parts = Parallel(n_jobs=edges.size - 1)(
+            delayed(_superob)(grid, np.nonzero(np.logical_and(
+                tidx >= lo, tidx < hi))[0], time, tidx, lon, lat, depth,
+                data, masks, depth_adjust)
+            for lo, hi in zip(edges[:-1], edges[1:]))
+    else:
+        parts = [_superob(grid, np.arange(lon.size), time, tidx, lon, lat,
+                          depth, data, masks, depth_adjust)]
+    if not any(p["count"] for p in parts):
+        return None
+    sobs = {f: np.concatenate([p[f] for p in parts])
+            for f in parts[0] if f != "count"}
+    (olat, olon) = grid.latlon((sobs["x"], sobs["y"]))
+
+    # Build the depth vectors
+    if depth is None:
+        sobs["z"] = np.resize(grid.n, sobs["x"].size)
+        sobs["depth"] = sobs["z"]
+    otype = np.hstack([np.resize(seapy.roms.obs.astype(v.type), 1)
+                       for v in data])[sobs["data"]]
+    oprov = np.hstack([np.resize(seapy.roms.obs.asprovenance(v.provenance), 1)
+                       for v in data])[sobs["data"]]
+
+    # Put everything together and create an observation class
+    return seapy.roms.obs.obs(time=sobs["time"],
+                              x=sobs["x"], y=sobs["y"], z=sobs["z"],
+                              lat=olat, lon=olon, depth=sobs["depth"],
+                              value=sobs["value"], error=sobs["error"],
+                              type=otype, provenance=oprov,
+                              title=title)
+
+
+def _superob(grid, l, time, tidx, lon, lat, depth, data, masks,
+             depth_adjust):
+    """
+    Internal function to place the selected raw observations onto the grid
+    and reduce the co-located values of each time bin into superobs for
+    gridder.
+
+    Parameters
+    ----------
+    grid : seapy.model.grid,
+        Grid to place the raw observations onto
+    l : ndarray,
+        indices of the raw observations to process. The time bins must not
+        be split between calls.
+    time, tidx, lon, lat, depth : ndarray,
+        time, time bin, and location of each raw observation. The depths
+        must be negative [m] (or None for surface values), as they are
+        averaged into the depths of the superobs.
+    data : list of seapy.roms.obs.raw_data,
+        observation data types to superob with unmasked values and errors
+    masks : list of ndarray,
+        the mask of the values of each data type, or None if unmasked
+    depth_adjust : bool,
+        adjust depths beyond the grid as for grid.ijk
+
+    Returns
+    -------
+    dict of the time, x, y, z, depth, value, error, and data type index of
+    each superob, and the count of the valid raw observations
+    """
+    time, tidx, lon, lat = time[l], tidx[l], lon[l], lat[l]
 
     # Get the appropriate k-dimension depending on whether the data
     # are 2-D or 3-D
@@ -656,12 +1186,11 @@ def gridder(grid, time, lon, lat, depth, data, dt, depth_adjust=False,
         # Get the grid locations from the data locations
         subsurface_values = False
         (j, i) = grid.ij((lon, lat))
-        depth = grid.n * np.ones(i.size)
         k = np.ma.array(np.resize(grid.n, i.size))
     else:
         # Get the grid locations from the data locations
         subsurface_values = True
-        depth = np.atleast_1d(depth)[region_list]
+        depth = depth[l]
         (k, j, i) = grid.ijk((lon, lat, depth), depth_adjust)
 
     # Sub-select only the points that lie on our grid
@@ -669,128 +1198,76 @@ def gridder(grid, time, lon, lat, depth, data, dt, depth_adjust=False,
     i = i[valid_list].compressed()
     j = j[valid_list].compressed()
     k = k[valid_list].compressed()
-    depth = depth[valid_list]
-
-    # Make sure the times are consistent and in dt-space
-    if time.size == 1:
-        time = np.resize(time, valid_list[0].size)
+    time = time[valid_list]
+
+    # Find the mean time of each time bin
+    tbins, tidx = np.unique(tidx[valid_list], return_inverse=True)
+    tcount = np.bincount(tidx)
+    mtime = np.array([np.nanmean(t) for t in np.split(
+        time[np.argsort(tidx, kind="stable")], np.cumsum(tcount)[:-1])]
+        if tcount.size else [])
+
+    # Gather the valid values of each data type with its grid cell,
+    # time bin, and data type index
+    if subsurface_values:
+        cells = np.floor(np.vstack((k, j, i))).astype(int)
     else:
-        time = time[region_list][valid_list]
-    dtime = np.floor(time / dt)
-
-    # Loop over all time intervals putting everything together. NOTE: The
-    # preference is to use aggregate over the time-dimension just as we do
-    # in the spatial-dimension; however, this led to crashing.
-    ot = list()
-    ox = list()
-    oy = list()
-    oz = list()
-    odep = list()
-    olon = list()
-    olat = list()
-    oval = list()
-    oerr = list()
-    oprov = list()
-    otype = list()
-    for t in track(np.unique(dtime)):
-        time_list = np.where(dtime == t)
-        mtime = np.nanmean(time[time_list])
-
-        for v in data:
-            valid_data = np.s_[:]
-            if isinstance(v.values, np.ma.core.MaskedArray):
-                valid_data = \
-                    (v.values[region_list][valid_list][time_list].nonzero())[0]
-                if not valid_data.size:
-                    continue
-
-            # Put together the indices based on the type of data we have
-            if subsurface_values:
-                idx = (k[time_list][valid_data],
-                       j[time_list][valid_data],
-                       i[time_list][valid_data])
-            else:
-                idx = (j[time_list][valid_data],
-                       i[time_list][valid_data])
-            indices = np.floor(idx).astype(int)
-
-            # Grid the data onto our grid and compute the mean and variance
-            ii = aggregate(indices, i[time_list][valid_data], func='mean')
-            jj = aggregate(indices, j[time_list][valid_data], func='mean')
-            binned = np.where(ii * jj > 0)
-            ii = ii[binned].ravel()
-            jj = jj[binned].ravel()
-            (latl, lonl) = grid.latlon((ii, jj))
-            Nd = ii.size
-
-            # Put the co-located values together
-            nvalues = aggregate(indices,
-                                v.values[region_list][valid_list][
-                                    time_list][valid_data],
-                                func='mean')
-
-            # Get their variance
-            vari = aggregate(indices,
-                             v.values[region_list][valid_list][
-                                 time_list][valid_data],
-                             func='var')
-
-            # Put together the known observation values
-            if v.error is not None:
-                errs = aggregate(indices,
-                                 v.error[region_list][valid_list][
-                                     time_list][valid_data]**2,
-                                 func='mean')
-                errs = errs[binned].flatten()
-            else:
-                errs = 0.0
-
-            # Build the depth vectors
-            if subsurface_values:
-                dd = aggregate(indices, depth[time_list][valid_data],
-                               func='mean')
-                kk = aggregate(indices, k[time_list][valid_data],
-                               func='mean')
-                dd = dd[binned].ravel()
-                # ROMS counts from 1 for depth layers
-                kk = kk[binned].ravel() + 1
-            else:
-                kk = np.resize(grid.n, Nd)
-                dd = kk
-
-            # Put all of the data from this time into our lists
-            ot.append(np.resize(mtime, Nd))
-            ox.append(ii)
-            oy.append(jj)
-            oz.append(kk)
-            odep.append(dd)
-            olon.append(lonl)
-            olat.append(latl)
-            oval.append(nvalues[binned].flatten())
-            otype.append(np.resize(seapy.roms.obs.astype(v.type), Nd))
-            oprov.append(np.resize(
-                seapy.roms.obs.asprovenance(v.provenance), Nd))
-            oerr.append(np.maximum(v.min_error**2,
-                                   np.maximum(vari[binned].flatten(),
-                                              errs)))
-
-    # Make sure that we have something relevant
-    if not oval:
-        return None
-
-    # Put everything together and create an observation class
-    return seapy.roms.obs.obs(time=np.hstack(ot).ravel(),
-                              x=np.hstack(ox).ravel(),
-                              y=np.hstack(oy).ravel(),
-                              z=np.hstack(oz).ravel(),
-                              lat=np.hstack(olat).ravel(),
-                              lon=np.hstack(olon).ravel(),
-                              depth=np.hstack(odep).ravel(),
-                              value=np.hstack(oval).ravel(),
-                              error=np.hstack(oerr).ravel(),
-                              type=np.hstack(otype).ravel(),
-                              provenance=np.hstack(oprov).ravel(),
-                              title=title)
+        cells = np.floor(np.vstack((j, i))).astype(int)
+    pts, dtype, vals, errs = [], [], [], []
+    for n, v in enumerate(data):
+        values = v.values[l][valid_list]
+        if masks[n] is not None:
+            valid = np.nonzero(np.logical_and(
+                values != 0, ~masks[n][l][valid_list]))[0]
+        else:
+            valid = np.arange(values.size)
+        pts.append(valid)
+        dtype.append(np.full(valid.size, n))
+        vals.append(values[valid])
+        if v.error is not None:
+            errs.append(v.error[l][valid_list][valid]**2)
+        else:
+            errs.append(np.zeros(valid.size))
+    pts = np.concatenate(pts)
+    dtype = np.concatenate(dtype)
+    vals = np.concatenate(vals)
+    errs = np.concatenate(errs)
+
+    # Sort by time bin, data type, and grid cell, and find the segments of
+    # co-located values to reduce into each superob. The sort is stable, so
+    # the values of each segment are reduced in their original order.
+    keys = np.vstack((tidx[pts], dtype, cells[:, pts]))
+    order = np.lexsort(keys[::-1])
+    keys = keys[:, order]
+    pts, dtype, vals, errs = pts[order], dtype[order], vals[order], \
+        errs[order]
+    start = np.ones(pts.size, dtype=bool)
+    start[1:] = np.any(np.diff(keys, axis=1) != 0, axis=0)
+    seg = np.cumsum(start) - 1
+    count = np.bincount(seg)
+
+    def mean(x):
+        return np.bincount(seg, weights=x) / count
+
+    # Compute the mean location, value, variance, and error of each superob
+    ii = mean(i[pts])
+    jj = mean(j[pts])
+    binned = np.where(ii * jj > 0)
+    nvalues = mean(vals)
+    vari = np.bincount(seg, weights=(vals - nvalues[seg])**2) / count
+    errs = mean(errs)
+    first = np.nonzero(start)[0][binned]
+    min_error = np.array([v.min_error for v in data])[dtype[first]]
+    sobs = {"time": mtime[keys[0, first]], "x": ii[binned], "y": jj[binned],
+            "value": nvalues[binned],
+            "error": np.maximum(min_error**2, np.maximum(vari[binned],
+                                                         errs[binned])),
+            "data": dtype[first], "count": pts.size}
+    if subsurface_values:
+        sobs["depth"] = mean(depth[valid_list][pts])[binned]
+        # ROMS counts from 1 for depth layers
+        sobs["z"] = mean(k[pts])[binned] + 1
+    return sobs
 
 
 def merge_files(obs_files, out_files, days, dt, limits=None, clobber=True):
@@ -857,6 +1334,7 @@ def merge_files(obs_files, out_files, days, dt, limits=None, clobber=True):
     myobs = list()
     sdays = list()
     edays = list()
+    surveys = list()
     for file in obs_files:
         nc = seapy.netcdf(file)
         fdays = nc.variables['survey_time'][:]
@@ -868,12 +1346,20 @@ def merge_files(obs_files, out_files, days, dt, limits=None, clobber=True):
         myobs.append(file)
         sdays.append(fdays[0])
         edays.append(fdays[-1])
+        surveys.append(fdays)
     sdays = np.asarray(sdays)
     edays = np.asarray(edays)
 
+    # Each survey of each file is read only once: going through the periods
+    # in order of their start, the observations that are read are buffered
+    # until the periods have passed them
+    unread = [np.ones(f.size, dtype=bool) for f in surveys]
+    buffers = [None] * len(myobs)
+
     # Loop over the dates in pairs
-    for n, t in track(enumerate(days), total=len(days),
-                      description="search files"):
+    order = sorted(range(len(days)), key=lambda n: days[n][0])
+    for n in track(order, total=len(days), description="merge files"):
+        t = days[n]
         # Set output file name
         if outtime:
             outfile = time.sub("{:05d}".format(t[0]), out_files)
@@ -888,14 +1374,26 @@ def merge_files(obs_files, out_files, days, dt, limits=None, clobber=True):
         if not fidx.size:
             continue
 
-        # Create new observations for this time period
-        nobs = obs(myobs[fidx[0]])
-        l = np.where(np.logical_or(nobs.time < t[0], nobs.time > t[1]))
-        nobs.delete(l)
-        for idx in fidx[1:]:
-            o = obs(myobs[idx])
-            l = np.where(np.logical_and(o.time >= t[0], o.time <= t[1]))
-            nobs.add(o[l])
+        # Create new observations for this time period from the buffered
+        # observations and the unread surveys within the period
+        build = obs_builder()
+        for idx in fidx:
+            times, buf = surveys[idx], buffers[idx]
+            if buf is not None:
+                buf.compress(buf.time >= t[0])
+            need = np.nonzero(np.logical_and.reduce(
+                (unread[idx], times >= t[0], times <= t[1])))[0]
+            unread[idx] &= times > t[1]
+            if need.size:
+                read = obs_builder()
+                if buf is not None:
+                    read.add(buf)
+                read.add(obs(myobs[idx], surveys=need))
+                buf = buffers[idx] = read.to_obs()
+            if buf is not None:
+                build.add(buf[np.where(np.logical_and(buf.time >= t[0],
+                                                      buf.time <= t[1]))])
+        nobs = build.to_obs()
         # Remove any limits
         if limits is not None:
             l = np.where(np.logical_or.reduce((
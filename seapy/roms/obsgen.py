@@ -158,8 +158,8 @@ def add_ssh_tides(obs, tide_file, tide_error, tide_start=None, provenance=None,
             if not tide_error[oy[cur], ox[cur]]:
                 bad.append(l[0][pts].tolist())
             else:
-                time = [reftime + datetime.timedelta(t) for t in
-                        obs.time[l][pts]]
+                time = np.datetime64(reftime, "us") + np.round(
+                    obs.time[l][pts] * 86400e6).astype("timedelta64[us]")
                 amppha = seapy.tide.pack_amp_phase(
                     frc['tides'], frc['Eamp'][:, oy[cur], ox[cur]],
                     frc['Ephase'][:, oy[cur], ox[cur]])
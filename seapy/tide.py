@@ -50,6 +50,27 @@ def _set_tides(tides=None):
     return default_tides if tides is None else np.array([t.upper() for t in np.atleast_1d(tides)])
 
 
+def _hours(times, ctime=None):
+    """
+    Private method: compute the hours of the times relative to ctime. If
+    ctime is not given, the center of the times is used. Arrays of
+    datetime64 are computed in a single vectorized operation. Returns the
+    hours and ctime as a datetime.
+    """
+    if getattr(times, "dtype", np.dtype(object)).kind != "M":
+        if ctime is None:
+            ctime = times[0] + (times[-1] - times[0]) / 2
+        return np.array([(t - ctime).total_seconds() / 3600.0
+                         for t in times]), ctime
+    times = np.atleast_1d(times).astype("datetime64[us]")
+    if ctime is None:
+        start, end = times[0].item(), times[-1].item()
+        ctime = start + (end - start) / 2
+    hours = (times - np.datetime64(ctime, "us")) / \
+        np.timedelta64(1, "s") / 3600.0
+    return hours, ctime
+
+
 def frequency(tides=None):
     """
     Returns array of the frequency in cycles per hour for the requested
@@ -278,7 +299,7 @@ def predict(times, tide, tide_minor=None, lat=55, tide_start=None):
 
     Parameters
     ----------
-    times : datetime array,
+    times : datetime or datetime64 array,
         The times of the predicted tide(s)
     tide : dict,
         Dictionary of the tides to predict with the constituent name as
@@ -320,12 +341,10 @@ def predict(times, tide, tide_minor=None, lat=55, tide_start=None):
     # If no tide_start is given, then everything is done as per standard.
     if tide_start:
         vufs = dict((ap.upper(), vuf_vals(0, 0, 1)) for ap in clist)
-        hours = np.array(
-            [(t - tide_start).total_seconds() / 3600.0 for t in times])
+        hours, _ = _hours(times, tide_start)
     else:
-        ctime = times[0] + (times[-1] - times[0]) / 2
+        hours, ctime = _hours(times)
         vufs = vuf(ctime, clist, lat)
-        hours = np.array([(t - ctime).total_seconds() / 3600.0 for t in times])
 
     # Calculate time series
     ts = np.zeros(len(times))
@@ -358,7 +377,7 @@ def fit(times, xin, tides=None, lat=55, tide_start=None, trend=True):
 
     Parameters
     ----------
-    times : datetime array,
+    times : datetime or datetime64 array,
         List of times matching each value of the time-series input
     xin : ndarray,
         Data values to perform the harmonic fit upon
@@ -405,15 +424,12 @@ def fit(times, xin, tides=None, lat=55, tide_start=None, trend=True):
     # Exclude long period tides if time series not long enough
     freq = frequency(tides)
     total_tides = len(tides)
-    total_hours = (times[-1] - times[0]).total_seconds() / 3600
+    hours, ctime = _hours(times)
+    total_hours = hours[-1] - hours[0]
     invalid_tides = [t for t, f in zip(tides, 1 / freq) if 2 * f > total_hours]
     tides = [t for t in tides if t not in invalid_tides]
     freq = frequency(tides)
 
-    # time series as hours from ctime
-    ctime = times[0] + (times[-1] - times[0]) / 2
-    hours = np.array([(t - ctime).total_seconds() / 3600.0 for t in times])
-
     # Generate cosines and sines for all the requested constitutents.
     if trend:
         A = np.hstack([np.cos(2 * np.pi * np.outer(hours, freq)),